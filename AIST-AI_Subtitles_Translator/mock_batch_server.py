@@ -0,0 +1,239 @@
+"""
+Local mock of the provider batch APIs for testing the batch mode of sub.py without an API key.
+
+Gemini:   POST /upload/v1beta/files (resumable upload of the JSONL input),
+          POST /v1beta/models/<model>:batchGenerateContent, GET /v1beta/batches/<id>,
+          GET /download/v1beta/files/<id>:download
+DeepSeek: POST /v1/files, POST /v1/batches, GET /v1/batches/<id>, GET /v1/files/<id>/content
+          (OpenAI-compatible files/batches flow)
+
+"Translation" is the source text with a "[<language>] " prefix. A job is reported as running
+for the first --polls status requests and is finished after that.
+
+Usage:
+    python mock_batch_server.py --port 8765
+    and in settings.txt: batch=1, batch_poll_interval=1 and
+    batch_api_url=http://127.0.0.1:8765/v1beta (gemini) or http://127.0.0.1:8765/v1 (deepseek)
+"""
+import argparse
+import json
+import logging
+import re
+import threading
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+_LANGUAGE_RE = re.compile(r'translation into (.+?) strictly')
+
+class MockState:
+    def __init__(self, polls: int):
+        self.polls = polls
+        self.lock = threading.Lock()
+        self.files: Dict[str, bytes] = {}
+        self.jobs: Dict[str, Dict] = {}
+        self.counter = 0
+
+    def next_id(self, prefix: str) -> str:
+        with self.lock:
+            self.counter += 1
+            return f"{prefix}{self.counter}"
+
+def fake_translation(prompt: str) -> str:
+    """
+    Echoes the numbered blocks of a sub.py prompt, in the format the prompt asks for.
+    """
+    match = _LANGUAGE_RE.search(prompt)
+    language = match.group(1) if match else 'translated'
+    if 'Text to translate:\n' in prompt:
+        text = prompt.split('Text to translate:\n', 1)[1]
+    else:
+        text = prompt.split('\n\n', 1)[1] if '\n\n' in prompt else prompt
+
+    items = []
+    for block in text.strip().split('\n\n'):
+        number, _, line = block.partition('\n')
+        if number.strip().isdigit():
+            items.append((int(number), f"[{language}] {line}"))
+
+    if '"items"' in prompt:  # output_format=json
+        return json.dumps({"items": [{"id": number, "text": line} for number, line in items]}, ensure_ascii=False)
+    return '\n\n'.join(f"{number}\n{line}" for number, line in items)
+
+def gemini_response(request: Dict) -> Dict:
+    contents = [request.get('systemInstruction', {})] + request.get('contents', [])
+    prompt = '\n\n'.join(part.get('text', '') for content in contents for part in content.get('parts', []))
+    return {"candidates": [{"content": {"parts": [{"text": fake_translation(prompt)}], "role": "model"},
+                            "finishReason": "STOP"}]}
+
+def chat_response(body: Dict) -> Dict:
+    prompt = '\n\n'.join(message.get('content', '') for message in body.get('messages', []))
+    return {"choices": [{"index": 0, "message": {"role": "assistant", "content": fake_translation(prompt)},
+                         "finish_reason": "stop"}]}
+
+class MockHandler(BaseHTTPRequestHandler):
+    state: MockState = None
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.command} {self.path} - {format % args}")
+
+    def _send_json(self, data, status: int = 200):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_content(self, content: Optional[bytes]):
+        if content is None:
+            self._send_json({"error": {"message": "Not found"}}, 404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/jsonl')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _job_finished(self, job: Dict) -> bool:
+        job['polls'] += 1
+        return job['polls'] > self.state.polls
+
+    def do_POST(self):
+        path = self.path.split('?', 1)[0]
+        body = self._read_body()
+
+        if path == '/upload/v1beta/files':
+            if self.headers.get('X-Goog-Upload-Command') == 'start':
+                upload_id = self.state.next_id('upload-')
+                self.send_response(200)
+                self.send_header('X-Goog-Upload-URL', f"http://{self.headers['Host']}/upload/v1beta/files?upload_id={upload_id}")
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            name = self.state.next_id('files/')
+            self.state.files[name] = body
+            self._send_json({"file": {"name": name}})
+            return
+
+        if path.startswith('/v1beta/models/') and path.endswith(':batchGenerateContent'):
+            batch = json.loads(body)['batch']
+            input_config = batch['input_config']
+            if 'file_name' in input_config:
+                lines = self.state.files.get(input_config['file_name'], b'').decode('utf-8').splitlines()
+                requests_list = [json.loads(line) for line in lines if line.strip()]
+            else:
+                requests_list = [{'key': item.get('metadata', {}).get('key'), 'request': item['request']}
+                                 for item in input_config['requests']['requests']]
+            name = self.state.next_id('batches/')
+            self.state.jobs[name] = {'kind': 'gemini', 'requests': requests_list, 'polls': 0,
+                                     'from_file': 'file_name' in input_config}
+            self._send_json({"name": name, "metadata": {"state": "BATCH_STATE_PENDING"}})
+            return
+
+        if path == '/v1/files':
+            message = BytesParser(policy=default_policy).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode('utf-8') + body)
+            content = b''
+            for part in message.iter_parts():
+                if part.get_filename():
+                    content = part.get_payload(decode=True)
+            file_id = self.state.next_id('file-')
+            self.state.files[file_id] = content
+            self._send_json({"id": file_id, "object": "file", "purpose": "batch"})
+            return
+
+        if path == '/v1/batches':
+            data = json.loads(body)
+            lines = self.state.files.get(data['input_file_id'], b'').decode('utf-8').splitlines()
+            batch_id = self.state.next_id('batch-')
+            self.state.jobs[batch_id] = {'kind': 'openai', 'requests': [json.loads(line) for line in lines if line.strip()],
+                                         'polls': 0}
+            self._send_json({"id": batch_id, "object": "batch", "status": "validating"})
+            return
+
+        self._send_json({"error": {"message": f"Unknown path {path}"}}, 404)
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+
+        if path.startswith('/v1beta/batches/'):
+            name = path[len('/v1beta/'):]
+            job = self.state.jobs.get(name)
+            if job is None:
+                self._send_json({"error": {"message": "Not found"}}, 404)
+            elif not self._job_finished(job):
+                self._send_json({"name": name, "metadata": {"state": "BATCH_STATE_RUNNING"}, "done": False})
+            elif job['from_file']:
+                output_name = job.get('output_file')
+                if output_name is None:
+                    lines = [json.dumps({"key": item['key'], "response": gemini_response(item['request'])},
+                                        ensure_ascii=False) for item in job['requests']]
+                    output_name = job['output_file'] = self.state.next_id('files/')
+                    self.state.files[output_name] = '\n'.join(lines).encode('utf-8')
+                self._send_json({"name": name, "metadata": {"state": "BATCH_STATE_SUCCEEDED"}, "done": True,
+                                 "response": {"responsesFile": output_name}})
+            else:
+                responses = [{"response": gemini_response(item['request']), "metadata": {"key": item['key']}}
+                             for item in job['requests']]
+                self._send_json({"name": name, "metadata": {"state": "BATCH_STATE_SUCCEEDED"}, "done": True,
+                                 "response": {"inlinedResponses": {"inlinedResponses": responses}}})
+            return
+
+        match = re.fullmatch(r'/download/v1beta/(files/[^/:]+):download', path)
+        if match:
+            self._send_content(self.state.files.get(match.group(1)))
+            return
+
+        match = re.fullmatch(r'/v1/files/([^/]+)/content', path)
+        if match:
+            self._send_content(self.state.files.get(match.group(1)))
+            return
+
+        if path.startswith('/v1/batches/'):
+            batch_id = path[len('/v1/batches/'):]
+            job = self.state.jobs.get(batch_id)
+            if job is None:
+                self._send_json({"error": {"message": "Not found"}}, 404)
+            elif not self._job_finished(job):
+                self._send_json({"id": batch_id, "object": "batch", "status": "in_progress"})
+            else:
+                output_id = job.get('output_file_id')
+                if output_id is None:
+                    lines = [json.dumps({"id": f"{batch_id}-{n}", "custom_id": item['custom_id'],
+                                         "response": {"status_code": 200, "body": chat_response(item['body'])}},
+                                        ensure_ascii=False)
+                             for n, item in enumerate(job['requests'])]
+                    output_id = job['output_file_id'] = self.state.next_id('file-')
+                    self.state.files[output_id] = '\n'.join(lines).encode('utf-8')
+                self._send_json({"id": batch_id, "object": "batch", "status": "completed", "output_file_id": output_id})
+            return
+
+        self._send_json({"error": {"message": f"Unknown path {path}"}}, 404)
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Local mock of Gemini and OpenAI-compatible batch APIs")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--polls', type=int, default=1, help="status requests answered with 'running' before a job is done")
+    args = parser.parse_args(argv)
+
+    MockHandler.state = MockState(args.polls)
+    server = ThreadingHTTPServer((args.host, args.port), MockHandler)
+    logger.info(f"Mock batch server on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,23 @@
+import argparse
 import glob
-from typing import List, Tuple, Dict, Optional, Set
+import sys
+from typing import List, Tuple, Dict, Optional, Set, Callable, Iterator
 import logging
 import time
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import re
 import os
 import random
+from array import array
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+from contextlib import nullcontext
+from email.utils import parsedate_to_datetime
 
 logging.basicConfig(
     level=logging.INFO , 
@@ -23,15 +34,664 @@ logger = logging.getLogger(__name__)
 
 MAX_CHUNK_SIZE = 0
 BASE_DELAY = 3
+MAX_BACKOFF = 120
 DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
 GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent" 
 SETTINGS_FILE = 'settings.txt'
+CACHE_FILE = 'translation_cache.sqlite'
+CHECKPOINT_DIR = 'checkpoints'
+BATCH_STATE_FILE = 'batch_job.json'
+GEMINI_API_BASE_URL = "https://generativelanguage.googleapis.com/v1beta"
+DEEPSEEK_BATCH_URL = "https://api.deepseek.com/v1"  # OpenAI-compatible files/batches API
+GEMINI_CACHE_MIN_TOKENS = 4096  # smaller contents can not be cached explicitly
+GEMINI_CACHE_TTL = 3600  # seconds, the cache is deleted when the file is done
+HEDGE_MIN_SAMPLES = 5  # chunk latencies observed before hedged requests are sent
+HEDGE_POLL_INTERVAL = 0.2  # seconds between checks for a free request slot for a hedged request
+PROMPT_VERSION = 3  # Increase when the translation prompt changes, so old cached translations are not reused
 
 class ChunkInfo:
-    def __init__(self, indices: List[int], content: str):
+    def __init__(self, indices: List[int], content: str, context: str = '', context_indices: List[int] = None):
         self.indices = indices
         self.content = content
         self.size = len(content.encode('utf-8'))
+        # Read-only lines around the chunk, sent for context only (not translated and not in the reply)
+        self.context = context
+        self.context_indices = context_indices or []
+
+class RateLimiter:
+    """
+    Token bucket limiter of one API provider with requests/min and tokens/min budgets (0 - unlimited).
+    acquire() blocks only when a budget is exhausted. After HTTP 429/503 backoff() pauses all
+    requests (for Retry-After seconds if the server sent it) and halves the rates,
+    successful requests then restore them step by step.
+    """
+    def __init__(self, requests_per_minute: int = 0, tokens_per_minute: int = 0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_allowance = float(requests_per_minute)
+        self.token_allowance = float(tokens_per_minute)
+        self.rate_factor = 1.0
+        self.blocked_until = 0.0
+        self.consecutive_backoffs = 0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated
+        self.updated = now
+        if self.requests_per_minute:
+            self.request_allowance = min(float(self.requests_per_minute),
+                                         self.request_allowance + elapsed * self.requests_per_minute * self.rate_factor / 60)
+        if self.tokens_per_minute:
+            self.token_allowance = min(float(self.tokens_per_minute),
+                                       self.token_allowance + elapsed * self.tokens_per_minute * self.rate_factor / 60)
+
+    def _wait_time(self, now: float, tokens: int) -> float:
+        wait = self.blocked_until - now
+        if wait > 0:
+            return wait
+        # A request bigger than the whole budget must still pass once the bucket is full
+        needed_tokens = min(tokens, self.tokens_per_minute)
+        waits = [0.0]
+        if self.requests_per_minute and self.request_allowance < 1:
+            waits.append((1 - self.request_allowance) * 60 / (self.requests_per_minute * self.rate_factor))
+        if self.tokens_per_minute and self.token_allowance < needed_tokens:
+            waits.append((needed_tokens - self.token_allowance) * 60 / (self.tokens_per_minute * self.rate_factor))
+        return max(waits)
+
+    def expected_wait(self, tokens: int = 0) -> float:
+        """
+        Seconds acquire(tokens) would block right now, without taking anything from the budget.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            return self._wait_time(now, tokens)
+
+    def acquire(self, tokens: int = 0):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._wait_time(now, tokens)
+                if wait <= 0:
+                    if self.requests_per_minute:
+                        self.request_allowance -= 1
+                    if self.tokens_per_minute:
+                        self.token_allowance -= min(tokens, self.tokens_per_minute)
+                    return
+            time.sleep(wait)
+
+    def backoff(self, retry_after: Optional[float] = None):
+        with self.lock:
+            self.consecutive_backoffs += 1
+            if retry_after is None:
+                # Exponential delay + jitter
+                retry_after = BASE_DELAY * (2 ** (self.consecutive_backoffs - 1)) + random.uniform(0, 0.5)
+            delay = min(retry_after, MAX_BACKOFF)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            self.rate_factor = max(0.1, self.rate_factor / 2)
+        logger.warning(f"Provider is throttling requests, pausing for {delay:.1f} s")
+
+    def success(self):
+        with self.lock:
+            self.consecutive_backoffs = 0
+            self.rate_factor = min(1.0, self.rate_factor + 0.1)
+
+_rate_limiters: Dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(settings: Dict) -> RateLimiter:
+    """
+    Returns the shared rate limiter of the current API provider (created on first use).
+    """
+    api_provider = settings['api_provider']
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(api_provider)
+        if limiter is None:
+            limiter = RateLimiter(int(settings.get(f'{api_provider}_requests_per_minute', 0)),
+                                  int(settings.get(f'{api_provider}_tokens_per_minute', 0)))
+            _rate_limiters[api_provider] = limiter
+        return limiter
+
+class ProviderError(Exception):
+    """
+    Failed API request with its class (kind), which decides what happens next:
+    auth/config errors are fatal and abort the file instead of retrying,
+    throttle/server/network errors are retried after a pause (server/network errors
+    also count towards the circuit breaker), safety blocks and malformed replies
+    are retried in the next retry attempts.
+    """
+    AUTH = 'auth'            # bad or missing API key, no balance, no permission
+    CONFIG = 'config'        # invalid model or request
+    THROTTLE = 'throttle'    # HTTP 429/503
+    SERVER = 'server'        # other HTTP 5xx
+    NETWORK = 'network'      # connection errors and timeouts
+    SAFETY = 'safety'        # content blocked by the provider
+    MALFORMED = 'malformed'  # empty or unexpected reply
+
+    FATAL_KINDS = (AUTH, CONFIG)
+    # Throttling is handled by the rate limiter and does not count
+    PROVIDER_FAULTS = (SERVER, NETWORK)
+
+    def __init__(self, kind: str, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.kind = kind
+        self.status_code = status_code
+
+    @property
+    def fatal(self) -> bool:
+        return self.kind in self.FATAL_KINDS
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a provider/model that keeps failing. Opens after `failures` consecutive
+    server/network errors (0 - never) and at once after an auth/config error.
+    While open, requests wait until `cooldown` seconds have passed (after an auth/config error they
+    fail at once with the same error). Then one probe request is let through and the other requests
+    wait for its result: success closes the breaker, another failure opens it again.
+    """
+    def __init__(self, failures: int = 5, cooldown: float = 60):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.last_error: Optional[ProviderError] = None
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    def _is_open(self, now: float) -> bool:
+        return self.opened_at is not None and (self.probing or now - self.opened_at < self.cooldown)
+
+    def is_open(self) -> bool:
+        with self.lock:
+            return self._is_open(time.monotonic())
+
+    def check(self):
+        """
+        Blocks while the breaker is open and lets the request through once it is closed or the request
+        is the probe. Raises ProviderError if the breaker was opened by an auth/config error.
+        """
+        with self.changed:
+            while self.opened_at is not None:
+                remaining = self.opened_at + self.cooldown - time.monotonic()
+                if remaining > 0:
+                    if self.last_error is not None and self.last_error.fatal:
+                        raise ProviderError(self.last_error.kind, f"{self.last_error} (circuit breaker is open)",
+                                            self.last_error.status_code)
+                    self.changed.wait(remaining)
+                elif self.probing:
+                    self.changed.wait()
+                else:
+                    self.probing = True
+                    return
+
+    def success(self):
+        with self.changed:
+            if self.opened_at is not None:
+                logger.info("Provider is responding again, circuit breaker closed")
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.probing = False
+            self.changed.notify_all()
+
+    def failure(self, error: ProviderError):
+        if error.kind == ProviderError.THROTTLE:
+            with self.changed:
+                # A throttled probe says nothing about the provider, the next request probes again
+                self.probing = False
+                self.changed.notify_all()
+            return
+        if error.kind not in ProviderError.PROVIDER_FAULTS and not error.fatal:
+            # The provider answered, only this text failed
+            self.success()
+            return
+        with self.changed:
+            self.last_error = error
+            self.consecutive_failures += 1
+            if error.fatal or self.probing or (self.failures and self.consecutive_failures >= self.failures):
+                if not self._is_open(time.monotonic()) or self.probing:
+                    logger.error(f"Circuit breaker opened for {self.cooldown:.0f} s: {error}")
+                self.opened_at = time.monotonic()
+                self.probing = False
+                self.changed.notify_all()
+
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+_circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(settings: Dict) -> CircuitBreaker:
+    """
+    Returns the shared circuit breaker of the current API provider and model (created on first use).
+    """
+    api_provider = settings['api_provider']
+    key = f"{api_provider}:{settings.get(f'{api_provider}_model', '')}"
+    with _circuit_breakers_lock:
+        breaker = _circuit_breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(int(settings.get('circuit_breaker_failures', 5)),
+                                     float(settings.get('circuit_breaker_cooldown', 60)))
+            _circuit_breakers[key] = breaker
+        return breaker
+
+_http_sessions: Dict[str, requests.Session] = {}
+_http_sessions_lock = threading.Lock()
+
+_request_slots: Optional[threading.BoundedSemaphore] = None
+_request_slots_lock = threading.Lock()
+
+class LatencyTracker:
+    """
+    Latencies of the last chunk requests, used to detect stragglers for hedged requests.
+    """
+    def __init__(self, size: int = 200):
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, percent: float) -> Optional[float]:
+        """
+        Returns the given percentile of the observed latencies, None until HEDGE_MIN_SAMPLES are observed.
+        """
+        with self.lock:
+            if len(self.samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.samples)
+        position = min(len(ordered) - 1, int(len(ordered) * percent / 100))
+        return ordered[position]
+
+_latency_tracker = LatencyTracker()
+
+def get_request_slots(settings: Dict) -> threading.BoundedSemaphore:
+    """
+    Returns the global semaphore limiting API requests in flight to settings['concurrency'],
+    shared by all chunks of all files processed at the same time.
+    """
+    global _request_slots
+    with _request_slots_lock:
+        if _request_slots is None:
+            _request_slots = threading.BoundedSemaphore(max(1, int(settings.get('concurrency', 1))))
+        return _request_slots
+
+def get_http_session(settings: Dict) -> requests.Session:
+    """
+    Returns the shared keep-alive session of the current API provider (created on first use),
+    so the TCP+TLS handshake is paid once and not for every chunk.
+    The connection pool holds pool_size connections (0 - as many as parallel requests).
+    """
+    api_provider = settings['api_provider']
+    with _http_sessions_lock:
+        session = _http_sessions.get(api_provider)
+        if session is None:
+            pool_size = int(settings.get('pool_size', 0)) or max(1, int(settings.get('concurrency', 1)))
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_sessions[api_provider] = session
+        return session
+
+def close_http_sessions():
+    with _http_sessions_lock:
+        for session in _http_sessions.values():
+            session.close()
+        _http_sessions.clear()
+
+class TranslationCache:
+    """
+    On-disk SQLite cache of translations. Keys are hashes of the source text (a single line
+    or a whole chunk) together with the target language, provider, model and prompt version.
+    When the total size exceeds max_bytes, the least recently used entries are evicted.
+    get_many/put_many handle all lines of a file or chunk in one transaction.
+    """
+    SQL_BATCH = 500  # keys per query, below the SQLite limit of bound parameters
+
+    def __init__(self, path: str, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)")
+        self.conn.commit()
+        self.total_size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        return self.get_many([key]).get(key)
+
+    def put(self, key: str, value: str):
+        self.put_many([(key, value)])
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        """
+        Returns {key: value} for the cached keys, last_used of the hits is updated in one transaction.
+        """
+        keys = list(dict.fromkeys(keys))
+        found: Dict[str, str] = {}
+        if not keys:
+            return found
+        with self.lock:
+            for start in range(0, len(keys), self.SQL_BATCH):
+                batch = keys[start:start + self.SQL_BATCH]
+                placeholders = ','.join('?' * len(batch))
+                found.update(self.conn.execute(f"SELECT key, value FROM cache WHERE key IN ({placeholders})",
+                                               batch).fetchall())
+            if found:
+                now = time.time()
+                self.conn.executemany("UPDATE cache SET last_used = ? WHERE key = ?", ((now, key) for key in found))
+                self.conn.commit()
+        return found
+
+    def put_many(self, items: List[Tuple[str, str]]):
+        """
+        Stores (key, value) pairs in one transaction.
+        """
+        entries = dict(items)
+        if not entries:
+            return
+        now = time.time()
+        with self.lock:
+            keys = list(entries)
+            for start in range(0, len(keys), self.SQL_BATCH):
+                batch = keys[start:start + self.SQL_BATCH]
+                placeholders = ','.join('?' * len(batch))
+                for (old_size,) in self.conn.execute(f"SELECT size FROM cache WHERE key IN ({placeholders})", batch):
+                    self.total_size -= old_size
+            rows = [(key, value, len(key) + len(value.encode('utf-8')), now) for key, value in entries.items()]
+            self.conn.executemany("INSERT OR REPLACE INTO cache (key, value, size, last_used) VALUES (?, ?, ?, ?)", rows)
+            self.total_size += sum(row[2] for row in rows)
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        while self.total_size > self.max_bytes:
+            rows = self.conn.execute("SELECT key, size FROM cache ORDER BY last_used LIMIT 100").fetchall()
+            if not rows:
+                self.total_size = 0
+                break
+            for key, size in rows:
+                self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self.total_size -= size
+                if self.total_size <= self.max_bytes:
+                    break
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+_translation_cache: Optional[TranslationCache] = None
+_translation_cache_lock = threading.Lock()
+
+def get_translation_cache(settings: Dict) -> Optional[TranslationCache]:
+    """
+    Returns the shared translation cache, or None if it is disabled (cache_size_mb=0).
+    """
+    global _translation_cache
+    cache_size_mb = int(settings.get('cache_size_mb', 0))
+    if cache_size_mb <= 0:
+        return None
+    with _translation_cache_lock:
+        if _translation_cache is None:
+            try:
+                _translation_cache = TranslationCache(CACHE_FILE, cache_size_mb * 1024 * 1024)
+            except sqlite3.Error as e:
+                logger.error(f"Translation cache is unavailable: {e}")
+                return None
+        return _translation_cache
+
+def close_translation_cache():
+    global _translation_cache
+    with _translation_cache_lock:
+        if _translation_cache is not None:
+            _translation_cache.close()
+            _translation_cache = None
+
+def normalize_source_text(text: str) -> str:
+    return '\n'.join(' '.join(line.split()) for line in text.strip().splitlines())
+
+def cache_key(kind: str, text: str, settings: Dict) -> str:
+    """
+    Builds a cache key for a single subtitle line (kind='line') or a whole chunk (kind='chunk').
+    """
+    api_provider = settings['api_provider']
+    # With several backends or a model ladder a translation may come from any of the models
+    model = (settings.get('backends') or settings.get(f'{api_provider}_model_ladder')
+             or settings.get(f'{api_provider}_model', ''))
+    key_data = [PROMPT_VERSION, kind, settings['target_language'].lower(), api_provider, model,
+                normalize_source_text(text)]
+    return hashlib.sha256(json.dumps(key_data, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def apply_cached_translations(indices: Set[int],
+                              subtitles: List[str],
+                              translated_subs: List[str],
+                              settings: Dict) -> Set[int]:
+    """
+    Fills translated_subs with cached translations of single lines
+    and returns the indices that still have to be sent to the API.
+    """
+    cache = get_translation_cache(settings)
+    if cache is None:
+        return set(indices)
+
+    pending = set()
+    keys = {}
+    for idx in indices:
+        if subtitles[idx].strip():
+            keys[idx] = cache_key('line', subtitles[idx], settings)
+        else:
+            pending.add(idx)
+    cached = cache.get_many(list(keys.values()))
+    for idx, key in keys.items():
+        if key in cached:
+            translated_subs[idx] = cached[key]
+        else:
+            pending.add(idx)
+    if len(pending) < len(indices):
+        logger.info(f"Translations taken from cache: {len(indices) - len(pending)} lines")
+    return pending
+
+class CheckpointJournal:
+    """
+    Append-only journal of translated lines of one input file, so an interrupted run can be resumed.
+    The first line is a header describing the source file and translation settings,
+    every next line is one translated subtitle: {"i": index, "t": text}.
+    A journal with a different header (file or settings changed) is ignored and rewritten.
+    """
+    def __init__(self, path: str, header: Dict):
+        self.path = path
+        self.header = header
+        self.lock = threading.Lock()
+        self.file = None
+        self.header_matched = False  # load() accepted the existing journal, open() may append to it
+
+    def load(self) -> Dict[int, str]:
+        entries: Dict[int, str] = {}
+        self.header_matched = False
+        if not os.path.exists(self.path):
+            return entries
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                first_line = f.readline()
+                if not first_line or json.loads(first_line) != self.header:
+                    logger.info(f"Checkpoint {self.path} belongs to other file content or settings, ignoring it.")
+                    return {}
+                self.header_matched = True
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        entries[int(entry['i'])] = entry['t']
+                    except (ValueError, KeyError, TypeError):
+                        # The last line may be cut if the process was killed while writing it
+                        continue
+        except (OSError, ValueError) as e:
+            logger.error(f"Error reading checkpoint {self.path}: {str(e)}")
+            self.header_matched = False
+            return {}
+        return entries
+
+    def open(self, keep_existing: bool):
+        """
+        Opens the journal for writing. With keep_existing new entries are appended, but only to a journal
+        accepted by load(), any other journal is started over with the current header.
+        """
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        if keep_existing and self.header_matched and os.path.exists(self.path):
+            self.file = open(self.path, 'a', encoding='utf-8')
+            # A journal cut in the middle of a line must not glue the next entry to it
+            self.file.write('\n')
+        else:
+            self.file = open(self.path, 'w', encoding='utf-8')
+            self.file.write(json.dumps(self.header, ensure_ascii=False) + '\n')
+        self.file.flush()
+
+    def record(self, entries: Dict[int, str]):
+        if self.file is None or not entries:
+            return
+        with self.lock:
+            for idx, text in entries.items():
+                self.file.write(json.dumps({'i': idx, 't': text}, ensure_ascii=False) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+def file_sha256(filename: str) -> str:
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def open_checkpoint(filename: str, source_hash: str, settings: Dict) -> CheckpointJournal:
+    api_provider = settings['api_provider']
+    header = {
+        'file': filename,
+        'source': source_hash,
+        'target_language': settings['target_language'],
+        'api_provider': api_provider,
+        'model': (settings.get('backends') or settings.get(f'{api_provider}_model_ladder')
+                  or settings.get(f'{api_provider}_model', '')),
+        'prompt_version': PROMPT_VERSION,
+        'dedup': int(settings.get('dedup', 1))
+    }
+    # Files with the same name in different folders must not share a journal
+    path_hash = hashlib.sha256(os.path.abspath(filename).encode('utf-8')).hexdigest()[:12]
+    path = os.path.join(CHECKPOINT_DIR, f"{os.path.basename(filename)}.{path_hash}.journal")
+    return CheckpointJournal(path, header)
+
+def parse_retry_after(response) -> Optional[float]:
+    """
+    Reads Retry-After header (seconds or HTTP date). Returns None if missing or invalid.
+    """
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def classify_http_error(status_code: int, body: str) -> str:
+    """
+    Returns the ProviderError kind of an unsuccessful HTTP response.
+    """
+    if status_code in (401, 402, 403):
+        return ProviderError.AUTH
+    if status_code == 400 and ('API_KEY_INVALID' in body or 'API key not valid' in body):
+        return ProviderError.AUTH  # Gemini reports a bad key as 400
+    if status_code in (429, 503):
+        return ProviderError.THROTTLE
+    if status_code >= 500:
+        return ProviderError.SERVER
+    return ProviderError.CONFIG
+
+def http_error(provider_name: str, response, limiter: RateLimiter) -> ProviderError:
+    """
+    Builds the ProviderError of an unsuccessful response. Throttling and server errors
+    pause all requests to the provider (see RateLimiter.backoff).
+    """
+    kind = classify_http_error(response.status_code, response.text)
+    if kind == ProviderError.THROTTLE:
+        limiter.backoff(parse_retry_after(response))
+    elif kind == ProviderError.SERVER:
+        limiter.backoff()
+    return ProviderError(kind, f"{provider_name} API: HTTP {response.status_code} ({kind}): {response.text[:300]}",
+                         response.status_code)
+
+# Characters per token of typical LLM tokenizers, by script
+_CJK_RE = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+_CYRILLIC_RE = re.compile(r'[\u0400-\u04ff]')
+_OTHER_NON_LATIN_RE = re.compile(r'[^\x00-\u024f\u0400-\u04ff\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+CHARS_PER_TOKEN_LATIN = 4.0
+CHARS_PER_TOKEN_CYRILLIC = 2.5
+CHARS_PER_TOKEN_CJK = 1.0
+CHARS_PER_TOKEN_OTHER = 2.0
+
+def estimate_tokens(text: str) -> int:
+    """
+    Fast local token estimate: characters are counted per script (Latin, Cyrillic, CJK, other),
+    because the same number of bytes costs very different numbers of tokens in each script.
+    """
+    total = len(text)
+    cjk = len(_CJK_RE.findall(text))
+    cyrillic = len(_CYRILLIC_RE.findall(text))
+    other = len(_OTHER_NON_LATIN_RE.findall(text))
+    latin = total - cjk - cyrillic - other
+    tokens = (latin / CHARS_PER_TOKEN_LATIN + cyrillic / CHARS_PER_TOKEN_CYRILLIC
+              + cjk / CHARS_PER_TOKEN_CJK + other / CHARS_PER_TOKEN_OTHER)
+    return max(1, int(tokens + 0.5))
+
+_tiktoken_encoding = None
+
+def get_token_estimator(settings: Dict) -> Callable[[str], int]:
+    """
+    Returns the token counting function selected by token_estimator:
+    'heuristic' (default) or 'tiktoken' (exact BPE count, needs the optional tiktoken library).
+    """
+    global _tiktoken_encoding
+    if settings.get('token_estimator', 'heuristic') == 'tiktoken':
+        if _tiktoken_encoding is None:
+            try:
+                import tiktoken
+                _tiktoken_encoding = tiktoken.get_encoding('cl100k_base')
+            except Exception as e:
+                logger.warning(f"tiktoken is not available ({e}), using heuristic token estimate.")
+                settings['token_estimator'] = 'heuristic'
+                return estimate_tokens
+        return lambda text: max(1, len(_tiktoken_encoding.encode(text, disallowed_special=())))
+    return estimate_tokens
+
+def get_chunk_limit(settings: Dict, default_chunk_size: int = MAX_CHUNK_SIZE) -> Tuple[int, Callable[[str], int]]:
+    """
+    Returns the chunk size limit (0 - no chunking) and the function that measures one
+    numbered subtitle block including the blank line after it.
+    chunk_tokens > 0 sizes chunks in estimated tokens, otherwise chunk_size is used in UTF-8 bytes.
+    """
+    chunk_tokens = int(settings.get('chunk_tokens', 0))
+    if chunk_tokens > 0:
+        count_tokens = get_token_estimator(settings)
+        return chunk_tokens, lambda block: count_tokens(block) + 1
+    return int(settings.get('chunk_size', default_chunk_size)), lambda block: len(block.encode('utf-8')) + 2
 
 def create_default_settings():
     with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
@@ -45,6 +705,31 @@ def create_default_settings():
         f.write('chunk_size=0\n')
         f.write('max_retries=10\n')
         f.write('timeout=360\n')  
+        f.write('concurrency=1\n')
+        f.write('gemini_requests_per_minute=0\n')
+        f.write('gemini_tokens_per_minute=0\n')
+        f.write('deepseek_requests_per_minute=0\n')
+        f.write('deepseek_tokens_per_minute=0\n')
+        f.write('pool_size=0\n')
+        f.write('cache_size_mb=100\n')
+        f.write('resume=1\n')
+        f.write('file_workers=1\n')
+        f.write('stream=0\n')
+        f.write('chunk_tokens=0\n')
+        f.write('token_estimator=heuristic\n')
+        f.write('dedup=1\n')
+        f.write('output_format=text\n')
+        f.write('batch=0\n')
+        f.write('batch_poll_interval=30\n')
+        f.write('batch_api_url=\n')
+        f.write('file_context=0\n')
+        f.write('backends=\n')
+        f.write('hedge=0\n')
+        f.write('hedge_percentile=95\n')
+        f.write('gemini_model_ladder=\n')
+        f.write('deepseek_model_ladder=\n')
+        f.write('circuit_breaker_failures=5\n')
+        f.write('circuit_breaker_cooldown=60\n')
 
 def read_settings() -> Dict:
     settings = {
@@ -57,7 +742,32 @@ def read_settings() -> Dict:
         'deepseek_model': 'deepseek-chat',  
         'chunk_size': 0,
         'max_retries': 10,
-        'timeout': 360  
+        'timeout': 360,
+        'concurrency': 1,
+        'gemini_requests_per_minute': 0,
+        'gemini_tokens_per_minute': 0,
+        'deepseek_requests_per_minute': 0,
+        'deepseek_tokens_per_minute': 0,
+        'pool_size': 0,
+        'cache_size_mb': 100,
+        'resume': 1,
+        'file_workers': 1,
+        'stream': 0,
+        'chunk_tokens': 0,
+        'token_estimator': 'heuristic',
+        'dedup': 1,
+        'output_format': 'text',
+        'batch': 0,
+        'batch_poll_interval': 30,
+        'batch_api_url': '',
+        'file_context': 0,
+        'backends': '',
+        'hedge': 0,
+        'hedge_percentile': 95,
+        'gemini_model_ladder': '',
+        'deepseek_model_ladder': '',
+        'circuit_breaker_failures': 5,
+        'circuit_breaker_cooldown': 60
     }
     if not os.path.exists(SETTINGS_FILE):
         create_default_settings()
@@ -75,6 +785,13 @@ def read_settings() -> Dict:
                         settings[key] = int(value)
                     elif key == 'timeout':
                         settings[key] = int(value)
+                    elif key in ('concurrency', 'pool_size', 'cache_size_mb', 'resume', 'file_workers', 'stream',
+                                 'chunk_tokens', 'dedup', 'batch', 'batch_poll_interval',
+                                 'file_context', 'hedge', 'hedge_percentile', 'circuit_breaker_failures',
+                                 'circuit_breaker_cooldown'):
+                        settings[key] = int(value)
+                    elif key.endswith('_requests_per_minute') or key.endswith('_tokens_per_minute'):
+                        settings[key] = int(value)
                     else:
                         settings[key] = value
     # Ensure that api_provider is in settings, even if it was not in the file
@@ -94,6 +811,31 @@ def write_settings(settings: Dict):
         f.write(f"chunk_size={settings['chunk_size']}\n")
         f.write(f"max_retries={settings['max_retries']}\n")
         f.write(f"timeout={settings['timeout']}\n") 
+        f.write(f"concurrency={settings['concurrency']}\n")
+        f.write(f"gemini_requests_per_minute={settings['gemini_requests_per_minute']}\n")
+        f.write(f"gemini_tokens_per_minute={settings['gemini_tokens_per_minute']}\n")
+        f.write(f"deepseek_requests_per_minute={settings['deepseek_requests_per_minute']}\n")
+        f.write(f"deepseek_tokens_per_minute={settings['deepseek_tokens_per_minute']}\n")
+        f.write(f"pool_size={settings['pool_size']}\n")
+        f.write(f"cache_size_mb={settings['cache_size_mb']}\n")
+        f.write(f"resume={settings['resume']}\n")
+        f.write(f"file_workers={settings['file_workers']}\n")
+        f.write(f"stream={settings['stream']}\n")
+        f.write(f"chunk_tokens={settings['chunk_tokens']}\n")
+        f.write(f"token_estimator={settings['token_estimator']}\n")
+        f.write(f"dedup={settings['dedup']}\n")
+        f.write(f"output_format={settings['output_format']}\n")
+        f.write(f"batch={settings['batch']}\n")
+        f.write(f"batch_poll_interval={settings['batch_poll_interval']}\n")
+        f.write(f"batch_api_url={settings['batch_api_url']}\n")
+        f.write(f"file_context={settings['file_context']}\n")
+        f.write(f"backends={settings['backends']}\n")
+        f.write(f"hedge={settings['hedge']}\n")
+        f.write(f"hedge_percentile={settings['hedge_percentile']}\n")
+        f.write(f"gemini_model_ladder={settings['gemini_model_ladder']}\n")
+        f.write(f"deepseek_model_ladder={settings['deepseek_model_ladder']}\n")
+        f.write(f"circuit_breaker_failures={settings['circuit_breaker_failures']}\n")
+        f.write(f"circuit_breaker_cooldown={settings['circuit_breaker_cooldown']}\n")
 
 def configure_settings(settings: Dict):
     while True:
@@ -139,6 +881,17 @@ def configure_settings(settings: Dict):
         option_number_timeout = next_option
         next_option += 1
 
+        print(f"{next_option}. Parallel requests (current: {settings['concurrency']})")
+        option_number_concurrency = next_option
+        next_option += 1
+
+        if settings['api_provider'] in ('gemini', 'deepseek'):
+            provider = settings['api_provider']
+            print(f"{next_option}. Rate limit (current: {settings[f'{provider}_requests_per_minute']} requests/min, "
+                  f"{settings[f'{provider}_tokens_per_minute']} tokens/min, 0 - unlimited)")
+            option_number_rate_limit = next_option
+            next_option += 1
+
         print(f"{next_option}. Start processing")
         option_number_start = next_option
 
@@ -313,28 +1066,73 @@ def configure_settings(settings: Dict):
                         print("Enter an integer.")
                 continue
 
+            # Parallel requests
+            elif numeric_choice == option_number_concurrency:
+                while True:
+                    try:
+                        concurrency = int(input("Enter number of parallel requests (1-32): "))
+                        if 1 <= concurrency <= 32:
+                            settings['concurrency'] = concurrency
+                            write_settings(settings)
+                            print("Value updated")
+                            break
+                        else:
+                            print("Invalid value. Enter a number from 1 to 32")
+                    except ValueError:
+                        print("Enter an integer")
+                continue
+
+            # Rate limit
+            elif settings['api_provider'] in ('gemini', 'deepseek') and numeric_choice == option_number_rate_limit:
+                provider = settings['api_provider']
+                while True:
+                    try:
+                        rpm = int(input("Enter requests per minute (0 - unlimited): "))
+                        tpm = int(input("Enter tokens per minute (0 - unlimited): "))
+                        if rpm >= 0 and tpm >= 0:
+                            settings[f'{provider}_requests_per_minute'] = rpm
+                            settings[f'{provider}_tokens_per_minute'] = tpm
+                            write_settings(settings)
+                            print("Rate limit updated")
+                            break
+                        else:
+                            print("Invalid value. Enter a number from 0")
+                    except ValueError:
+                        print("Enter an integer")
+                continue
+
             # Start processing
             elif numeric_choice == option_number_start:
                 break
 
         print("Invalid choice")
 
+def stored_api_key(settings: Dict, api_provider: str) -> str:
+    """
+    Returns the API key of a provider from the environment or settings (empty if there is none), without asking.
+    """
+    return os.getenv(f"{api_provider.upper()}_API_KEY") or settings.get(f'{api_provider}_api_key', '')
+
 def get_api_key(settings: Dict) -> Optional[str]:
     api_provider = settings['api_provider']
     api_key = None
 
     if api_provider == 'deepseek':
-        api_key = os.getenv("DEEPSEEK_API_KEY") or settings['deepseek_api_key']
+        api_key = stored_api_key(settings, api_provider)
         env_var_name = "DEEPSEEK_API_KEY"
         setting_name = "deepseek_api_key"
     elif api_provider == 'gemini':
-        api_key = os.getenv("GEMINI_API_KEY") or settings['gemini_api_key']
+        api_key = stored_api_key(settings, api_provider)
         env_var_name = "GEMINI_API_KEY"
         setting_name = "gemini_api_key"
     else:
         logger.error(f"Unknown API provider: {api_provider}")
         return None
 
+    if not api_key and not settings.get('interactive', True):
+        logger.error(f"API key {api_provider} not found! Set {env_var_name} or {setting_name} in {SETTINGS_FILE}.")
+        return None
+
     if not api_key:
         print(f"\nAPI key {api_provider} not found!")
         api_key = input(f"Enter your API key {api_provider}: ").strip()
@@ -342,17 +1140,43 @@ def get_api_key(settings: Dict) -> Optional[str]:
         write_settings(settings)
     return api_key
 
+_TIME_RE = re.compile(r'\s*(\d+):(\d{1,2}):(\d{1,2})(?:[,.](\d{1,3}))?')
+_SRT_TIMECODE_RE = re.compile(r'\s*(\d+:\d{1,2}:\d{1,2}(?:[,.]\d{1,3})?)\s*-->\s*(\d+:\d{1,2}:\d{1,2}(?:[,.]\d{1,3})?)(.*)$')
+
+def parse_time_ms(time_str: str) -> int:
+    """
+    Converts time "h:mm:ss,mmm" (SRT) or "h:mm:ss.cc" (ASS) to integer milliseconds.
+    The fraction is read by its digits: ".5" = 500 ms, ".50" = 500 ms, ".500" = 500 ms.
+    Returns 0 if the string is not a time.
+    """
+    match = _TIME_RE.match(time_str)
+    if not match:
+        return 0
+    hours, minutes, seconds, fraction = match.groups()
+    milliseconds = int(fraction.ljust(3, '0')) if fraction else 0
+    return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + milliseconds
+
+def format_time_ms(ms: int) -> str:
+    """
+    Formats integer milliseconds into SRT time "hh:mm:ss,mmm".
+    """
+    seconds, milliseconds = divmod(ms, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02}:{minutes:02}:{seconds:02},{milliseconds:03}"
+
+def format_time_ass_ms(ms: int) -> str:
+    """
+    Formats integer milliseconds into ASS time "h:mm:ss.cc" (rounded to hundredths of a second).
+    """
+    centiseconds = (ms + 5) // 10
+    seconds, centiseconds = divmod(centiseconds, 100)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}.{centiseconds:02}"
+
 def parse_time(time_str: str) -> float:
-    parts = re.split(r'[:,]', time_str)
-    try:
-        return sum([
-            int(parts[0]) * 3600,
-            int(parts[1]) * 60,
-            int(parts[2]),
-            int(parts[3])/1000
-        ])
-    except (IndexError, ValueError):
-        return 0.0
+    return parse_time_ms(time_str) / 1000
 
 def parse_time_ass(time_str: str) -> float:
     """
@@ -362,25 +1186,10 @@ def parse_time_ass(time_str: str) -> float:
     Output: 62.50 (float)
     """
     # Format: HOURS:MINUTES:SECONDS.CENTISECONDS (or milliseconds, depends on software)
-    # Often 2 digits after the dot (hundredths of a second), but sometimes 3 digits (milliseconds).
-    # Let's parse the general case with a floating point.
-    try:
-        parts = time_str.split(':')  # [hours, minutes, "seconds.fractions"]
-        hours = int(parts[0])
-        minutes = int(parts[1])
-        sec_fraction = float(parts[2])  # seconds + decimal part
-        return hours * 3600 + minutes * 60 + sec_fraction
-    except Exception:
-        # If parsing fails, return 0
-        return 0.0
+    return parse_time_ms(time_str) / 1000
 
 def format_time(seconds: float) -> str:
-    hours = int(seconds // 3600)
-    remainder = seconds % 3600
-    minutes = int(remainder // 60)
-    seconds = remainder % 60
-    milliseconds = int((seconds - int(seconds)) * 1000)
-    return f"{hours:02}:{minutes:02}:{int(seconds):02},{milliseconds:03}"
+    return format_time_ms(round(seconds * 1000))
 
 def format_time_ass(seconds: float) -> str:
     """
@@ -389,77 +1198,234 @@ def format_time_ass(seconds: float) -> str:
     Example input: 62.50
     Output: "0:01:02.50"
     """
-    # Let's limit to two decimal places for compatibility
-    # (many .ass editors use hundredths of a second).
-    hours = int(seconds // 3600)
-    remainder = seconds % 3600
-    minutes = int(remainder // 60)
-    sec_fraction = remainder % 60  # this is seconds with a floating point
-    return f"{hours}:{minutes:02}:{sec_fraction:05.2f}"
+    return format_time_ass_ms(round(seconds * 1000))
+
+class Timeline:
+    """
+    Start and end times of all subtitles of a file as integer milliseconds in compact arrays.
+    Shift, clamp and format work on the whole file at once, and integer arithmetic
+    makes shifts exact (no float drift of a millisecond).
+    """
+    __slots__ = ('starts', 'ends')
+
+    def __init__(self, starts=(), ends=()):
+        self.starts = array('q', starts)
+        self.ends = array('q', ends)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def shift(self, shift_ms: int):
+        """
+        Moves all times by shift_ms, times that would become negative are clamped to 0.
+        """
+        if not shift_ms:
+            return
+        self.starts = array('q', [t + shift_ms if t + shift_ms > 0 else 0 for t in self.starts])
+        self.ends = array('q', [t + shift_ms if t + shift_ms > 0 else 0 for t in self.ends])
+
+    def format(self, formatter: Callable[[int], str]) -> Tuple[List[str], List[str]]:
+        return [formatter(t) for t in self.starts], [formatter(t) for t in self.ends]
+
+def shift_to_ms(shift: float) -> int:
+    return round(shift * 1000)
 
 def adjust_timecode(timecode: str, shift: float) -> str:
-    try:
-        start, end = timecode.split(' --> ')
-        start_sec = parse_time(start) + shift
-        end_sec = parse_time(end) + shift
-        return (
-            f"{format_time(max(start_sec, 0))} --> "
-            f"{format_time(max(end_sec, 0))}"
-        )
-    except Exception as e:
-        logger.error(f"Time correction error: {str(e)}")
-        return timecode
+    return shift_srt_timecodes([timecode], shift)[0]
 
-def adjust_timecode_ass(dialogues, shift: float):
+def shift_srt_timecodes(timecodes: List[str], shift: float) -> List[str]:
     """
-    Applies time shift (shift in seconds) to all dialogues in the dialogues list.
-    dialogues is a list of dictionaries, each has 'start' and 'end' (float).
+    Shifts a list of SRT timecode lines ("start --> end" and optional position after it)
+    through an integer millisecond Timeline. Lines that are not timecodes are kept as is.
+    """
+    matches = [_SRT_TIMECODE_RE.match(tc) for tc in timecodes]
+    parsed = [m for m in matches if m]
+    timeline = Timeline((parse_time_ms(m.group(1)) for m in parsed),
+                        (parse_time_ms(m.group(2)) for m in parsed))
+    timeline.shift(shift_to_ms(shift))
+    starts, ends = timeline.format(format_time_ms)
+
+    result = []
+    position = 0
+    for timecode, match in zip(timecodes, matches):
+        if match is None:
+            logger.error(f"Time correction error: not a timecode '{timecode}'")
+            result.append(timecode)
+            continue
+        result.append(f"{starts[position]} --> {ends[position]}{match.group(3).rstrip()}")
+        position += 1
+    return result
+
+_SRT_RETIME_RE = re.compile(r'^(\s*)(\d+:\d{1,2}:\d{1,2}(?:[,.]\d{1,3})?)(\s*-->\s*)(\d+:\d{1,2}:\d{1,2}(?:[,.]\d{1,3})?)')
+
+def retime_srt_line(line: str, shift_ms: int) -> Tuple[str, bool]:
+    match = _SRT_RETIME_RE.match(line)
+    if not match:
+        return line, False
+    lead, start, arrow, end = match.groups()
+    start_ms = max(0, parse_time_ms(start) + shift_ms)
+    end_ms = max(0, parse_time_ms(end) + shift_ms)
+    return f"{lead}{format_time_ms(start_ms)}{arrow}{format_time_ms(end_ms)}{line[match.end():]}", True
+
+def retime_ass_line(line: str, shift_ms: int, start_field: int, end_field: int) -> Tuple[str, bool]:
+    head, sep, rest = line.partition(':')
+    if not sep or head.strip().lower() not in ('dialogue', 'comment'):
+        return line, False
+    # Split only up to the last time field, so commas in the text are never touched
+    fields = rest.split(',', max(start_field, end_field) + 1)
+    if len(fields) <= max(start_field, end_field):
+        return line, False
+    for field_idx in (start_field, end_field):
+        value = fields[field_idx]
+        stripped = value.strip()
+        if not _TIME_RE.fullmatch(stripped):
+            return line, False
+        new_time = format_time_ass_ms(max(0, parse_time_ms(stripped) + shift_ms))
+        fields[field_idx] = value.replace(stripped, new_time, 1)
+    return head + sep + ','.join(fields), True
+
+def retime_file(filename: str, output_path: str, shift: float) -> int:
+    """
+    Shift-only mode: copies an SRT/ASS file line by line and rewrites only the timecode fields.
+    No dialogue structures are built and every other byte (line endings, BOM, styles, comments,
+    text, even invalid UTF-8) is kept as is. Returns the number of subtitles in the file
+    (SRT timecode lines, ASS Dialogue lines), also when the shift is zero.
+    """
+    shift_ms = shift_to_ms(shift)
+    is_ass = filename.lower().endswith('.ass')
+    in_events = False
+    start_field, end_field = 1, 2  # Layer, Start, End, ... unless the Format line says otherwise
+    subtitle_count = 0
+
+    with open(filename, 'r', encoding='utf-8', errors='surrogateescape', newline='') as src, \
+         open(output_path, 'w', encoding='utf-8', errors='surrogateescape', newline='') as dst:
+        for line in src:
+            if is_ass:
+                stripped = line.strip().lower()
+                if stripped.startswith('['):
+                    in_events = stripped == '[events]'
+                elif in_events and stripped.startswith('format:'):
+                    names = [name.strip().lower() for name in line.split(':', 1)[1].split(',')]
+                    if 'start' in names and 'end' in names:
+                        start_field, end_field = names.index('start'), names.index('end')
+                elif in_events:
+                    if stripped.startswith('dialogue:'):
+                        subtitle_count += 1
+                    if shift_ms:
+                        # The line ending stays outside of the rewritten part
+                        body = line.rstrip('\r\n')
+                        new_body, changed = retime_ass_line(body, shift_ms, start_field, end_field)
+                        if changed:
+                            line = new_body + line[len(body):]
+            elif '-->' in line and _SRT_RETIME_RE.match(line):
+                subtitle_count += 1
+                if shift_ms:
+                    line, _ = retime_srt_line(line, shift_ms)
+            dst.write(line)
+    return subtitle_count
 
-    As a result, changes 'start' and 'end' fields to corrected values (not less than 0).
+def adjust_timecode_ass(dialogues, shift: float):
+    """
+    Applies time shift (shift in seconds) to all dialogues in the dialogues list (AssEvent).
+    As a result, changes start and end fields to corrected values (not less than 0).
+    """
+    timeline = Timeline((d.start for d in dialogues), (d.end for d in dialogues))
+    timeline.shift(shift_to_ms(shift))
+    for d, start, end in zip(dialogues, timeline.starts, timeline.ends):
+        d.start = start
+        d.end = end
+
+def _srt_record(block: List[str]) -> Optional[Tuple[str, str, str]]:
+    if '-->' in block[0]:
+        # Block without index line: timecode comes first
+        return '', block[0].strip(), '\n'.join(block[1:]).rstrip()
+    if len(block) >= 3:
+        return block[0].strip(), block[1].strip(), '\n'.join(block[2:]).rstrip()
+    return None
+
+def iter_srt(lines) -> Iterator[Tuple[str, str, str]]:
+    """
+    Incremental SRT reader: takes any iterable of lines (e.g. an open file) and yields
+    (index, timecode, text) records one by one without loading the whole file.
+    Handles LF/CRLF/CR line endings, a UTF-8 BOM and runs of several blank lines.
     """
-    for d in dialogues:
-        new_start = d['start'] + shift
-        new_end = d['end'] + shift
-        if new_start < 0:
-            new_start = 0.0
-        if new_end < 0:
-            new_end = 0.0
-        d['start'] = new_start
-        d['end'] = new_end
+    block: List[str] = []
+    first = True
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if first:
+            line = line.lstrip('\ufeff')
+            first = False
+        if not line.strip():
+            if block:
+                record = _srt_record(block)
+                if record:
+                    yield record
+                block = []
+            continue
+        block.append(line)
+    if block:
+        record = _srt_record(block)
+        if record:
+            yield record
 
 def parse_srt(content: str) -> Tuple[List[str], List[str]]:
-    blocks = [b.strip() for b in content.split('\n\n') if b.strip()]
     timecodes = []
     subtitles = []
+    for _, timecode, text in iter_srt(content.splitlines()):
+        timecodes.append(timecode)
+        subtitles.append(text)
+    return timecodes, subtitles
 
-    for block in blocks:
-        lines = block.split('\n')
-        if len(lines) >= 3:
-            timecodes.append(lines[1])
-            subtitles.append('\n'.join(lines[2:]).rstrip())
-
+def read_srt(filename: str) -> Tuple[List[str], List[str]]:
+    """
+    Reads an SRT file line by line into (timecodes, subtitles).
+    """
+    timecodes = []
+    subtitles = []
+    # newline='' keeps '\r' so that iter_srt sees the original line endings of every kind
+    with open(filename, 'r', encoding='utf-8', newline='') as f:
+        for _, timecode, text in iter_srt(f):
+            timecodes.append(timecode)
+            subtitles.append(text)
     return timecodes, subtitles
 
-def parse_ass(content: str):
+def write_srt(output_path: str, timecodes: List[str], texts: List[str]):
     """
-    Parses the content of an .ass file, returning:
+    Writes SRT records one by one (renumbered from 1).
+    """
+    with open(output_path, 'w', encoding='utf-8') as f:
+        for i, (tc, text) in enumerate(zip(timecodes, texts), 1):
+            f.write(f"{i}\n{tc}\n{text}\n\n")
+
+class AssEvent:
+    """
+    One 'Dialogue:' line of an .ass file.
+    start/end are integer milliseconds, repeated short fields (layer, style, name, margins, effect)
+    are interned, so thousands of events share the same string objects.
+    """
+    __slots__ = ('layer', 'start', 'end', 'style', 'name', 'margin_l', 'margin_r', 'margin_v', 'effect', 'text')
+
+    def __init__(self, layer: str, start: int, end: int, style: str, name: str,
+                 margin_l: str, margin_r: str, margin_v: str, effect: str, text: str):
+        self.layer = sys.intern(layer)
+        self.start = start
+        self.end = end
+        self.style = sys.intern(style)
+        self.name = sys.intern(name)
+        self.margin_l = sys.intern(margin_l)
+        self.margin_r = sys.intern(margin_r)
+        self.margin_v = sys.intern(margin_v)
+        self.effect = sys.intern(effect)
+        self.text = text
+
+def parse_ass_lines(lines) -> Tuple[List[str], str, List[AssEvent], List[str]]:
+    """
+    Parses lines of an .ass file (any iterable, e.g. an open file), returning:
       - header_lines: all header lines (up to [Events], including the Script Info block, etc.)
       - events_format_line: 'Format:...' line (if present) from [Events] section
-      - dialogues: a list of dictionaries, where each dictionary describes a subtitle line:
-          {
-            'layer': str,
-            'start': float,
-            'end': float,
-            'style': str,
-            'name': str,
-            'margin_l': str,
-            'margin_r': str,
-            'margin_v': str,
-            'effect': str,
-            'text': str
-          }
-      - timecodes: a list of strings like "start --> end" (similar to SRT), to reuse chunk logic.
-      - subtitles: a list of only texts (at the same index as timecodes).
+      - dialogues: a list of AssEvent, one per subtitle line
+      - subtitles: a list of only texts (at the same index as dialogues), to reuse chunk logic.
 
     Example dialogue format:
       Dialogue: 0,0:01:02.50,0:01:05.00,Default,Nobody,0,0,0,,This is text
@@ -467,16 +1433,15 @@ def parse_ass(content: str):
     Order of fields after 'Dialogue:' matches:
       Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
     """
-    lines = content.split('\n')
     header_lines = []
     events_format_line = ""
     dialogues = []
 
     in_events_section = False
-    timecodes = []
     subtitles = []
 
     for line in lines:
+        line = line.rstrip('\r\n')
         stripped = line.strip()
         if not in_events_section:
             # Looking for [Events] block
@@ -503,289 +1468,313 @@ def parse_ass(content: str):
                 # Invalid structure
                 continue
 
-            layer_str = fields[0].strip()
-            start_str = fields[1].strip()
-            end_str = fields[2].strip()
-            style_str = fields[3].strip()
-            name_str = fields[4].strip()
-            margin_l_str = fields[5].strip()
-            margin_r_str = fields[6].strip()
-            margin_v_str = fields[7].strip()
-            effect_str = fields[8].strip()
-            text_str = fields[9]
-
-            start_sec = parse_time_ass(start_str)
-            end_sec = parse_time_ass(end_str)
-
-            dialogues.append({
-                'layer': layer_str,
-                'start': start_sec,
-                'end': end_sec,
-                'style': style_str,
-                'name': name_str,
-                'margin_l': margin_l_str,
-                'margin_r': margin_r_str,
-                'margin_v': margin_v_str,
-                'effect': effect_str,
-                'text': text_str
-            })
-
-            # For further translation logic, we create an SRT-like structure
-            # timecodes[i], subtitles[i]
-            srt_style_timecode = f"{format_time_ass(start_sec)} --> {format_time_ass(end_sec)}"
-            timecodes.append(srt_style_timecode)
-            subtitles.append(text_str)
+            event = AssEvent(
+                layer=fields[0].strip(),
+                start=parse_time_ms(fields[1].strip()),
+                end=parse_time_ms(fields[2].strip()),
+                style=fields[3].strip(),
+                name=fields[4].strip(),
+                margin_l=fields[5].strip(),
+                margin_r=fields[6].strip(),
+                margin_v=fields[7].strip(),
+                effect=fields[8].strip(),
+                text=fields[9]
+            )
+            dialogues.append(event)
+            subtitles.append(event.text)
 
         else:
             # Could be "Comment:" or something else. Save as is in header_lines
             # Or, if desired, you can process Comment: ... the same way.
             header_lines.append(line)
 
-    return header_lines, events_format_line, dialogues, timecodes, subtitles
+    return header_lines, events_format_line, dialogues, subtitles
 
-def reconstruct_ass(header_lines: list,
-                    events_format_line: str,
-                    dialogues: list,
-                    translated_subs: list) -> str:
+def parse_ass(content: str) -> Tuple[List[str], str, List[AssEvent], List[str]]:
+    return parse_ass_lines(content.split('\n'))
+
+def read_ass(filename: str) -> Tuple[List[str], str, List[AssEvent], List[str]]:
     """
-    Reassembles the final .ass text based on:
+    Reads an .ass file line by line (see parse_ass_lines).
+    """
+    with open(filename, 'r', encoding='utf-8') as f:
+        return parse_ass_lines(f)
+
+def iter_ass_lines(header_lines: List[str],
+                   events_format_line: str,
+                   dialogues: List[AssEvent],
+                   translated_subs: List[str]) -> Iterator[str]:
+    """
+    Yields the lines of the final .ass file based on:
       - header_lines (everything before and inside [Events], but without 'Dialogue:' lines),
       - events_format_line ('Format: ...' line),
-      - dialogues (list of dictionaries with keys: start, end, layer, style, name, margin_l, margin_r, margin_v, effect),
+      - dialogues (list of AssEvent),
       - translated_subs (list of final translated texts of the same length as dialogues).
-
-    Returns the final .ass string to write to a file.
     """
-    output_lines = []
     # First, add all header lines
-    for hl in header_lines:
-        output_lines.append(hl)
+    yield from header_lines
 
     # If there is a format line, add it
     if events_format_line:
-        output_lines.append(events_format_line)
+        yield events_format_line
 
     # Then add dialogue lines with translated text
-    for i, d in enumerate(dialogues):
-        start_str = format_time_ass(d['start'])
-        end_str = format_time_ass(d['end'])
-        text_str = translated_subs[i]  # translation or original if skipped
-
+    for d, text_str in zip(dialogues, translated_subs):  # translation or original if skipped
         # Assemble fields according to format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
-        line_fields = [
-            d['layer'],
-            start_str,
-            end_str,
-            d['style'],
-            d['name'],
-            d['margin_l'],
-            d['margin_r'],
-            d['margin_v'],
-            d['effect'],
-            text_str
-        ]
-        dialogue_str = "Dialogue: " + ",".join(line_fields)
-        output_lines.append(dialogue_str)
+        yield (f"Dialogue: {d.layer},{format_time_ass_ms(d.start)},{format_time_ass_ms(d.end)},{d.style},{d.name},"
+               f"{d.margin_l},{d.margin_r},{d.margin_v},{d.effect},{text_str}")
 
-    # Return the final text combined with translations
-    return "\n".join(output_lines) + "\n"
-
-def translate_chunk(chunk: ChunkInfo,
-                    settings: Dict,
-                    subtitles: List[str],
-                    translated_subs: List[str],
-                    attempt_type: str = "initial") -> Set[int]:
+def reconstruct_ass(header_lines: List[str],
+                    events_format_line: str,
+                    dialogues: List[AssEvent],
+                    translated_subs: List[str]) -> str:
     """
-    Translates a chunk of subtitles. In case of any index mismatch,
-    the remaining lines of this chunk are marked as "skipped".
+    Returns the final .ass string to write to a file (see iter_ass_lines).
     """
+    return "\n".join(iter_ass_lines(header_lines, events_format_line, dialogues, translated_subs)) + "\n"
 
-    failed_indices = set()
-    instruction_prefixes = ("Важно:", "Инструкция:", "Note:", "Important:") # Intentionally left in Russian and English
-
-    try:
-        translated_text = translate_text(chunk.content, settings)
-        if translated_text is None:
-            # API returned None (e.g., blocked by policy)
-            # Mark all lines of the chunk as failed
-            failed_indices.update(chunk.indices)
-            return failed_indices
-
-        translated_blocks = translated_text.strip().split('\n\n')
-        processed_indices = set()
-
-        # Preparing iterator over original line indices
-        chunk_indices_iter = iter(chunk.indices)
-        original_idx = next(chunk_indices_iter, None)
-
-        tb_index = 0  # index in translated blocks
-
-        while tb_index < len(translated_blocks) and original_idx is not None:
-            block = translated_blocks[tb_index].strip()
-            if not block:
-                # Empty translation block, skipping
-                tb_index += 1
-                continue
-
-            lines_in_block = block.split('\n')
-            first_line = lines_in_block[0].strip()
+def write_ass(output_path: str,
+              header_lines: List[str],
+              events_format_line: str,
+              dialogues: List[AssEvent],
+              translated_subs: List[str]):
+    """
+    Writes the final .ass file line by line (see iter_ass_lines).
+    """
+    with open(output_path, 'w', encoding='utf-8') as f:
+        for line in iter_ass_lines(header_lines, events_format_line, dialogues, translated_subs):
+            f.write(line + '\n')
 
-            # 1) Check: non-digit first line => instruction or "garbage"
-            if not first_line.isdigit():
-                # Checking for possible instruction prefixes
-                if any(first_line.startswith(pref) for pref in instruction_prefixes):
-                    # This is not a subtitle, but clearly a service instruction from the model
-                    tb_index += 1
-                    continue
-                else:
-                    # If it's not an instruction and not a number,
-                    # then we perceive it entirely as a translation for the current original_idx
-                    translated_subs[original_idx] = block
-                    processed_indices.add(original_idx)
-                    original_idx = next(chunk_indices_iter, None)
-                    tb_index += 1
-                    continue
-
-            # If the line is a digit, try to match indices
-            try:
-                translated_idx_from_block = int(first_line) - 1
-            except ValueError:
-                # Theoretically should not happen, but just in case
-                # If conversion fails - consider it an index error
-                # and mark the remaining lines
-                tail_index_pos = chunk.indices.index(original_idx)
-                missed_lines = chunk.indices[tail_index_pos:]
-                failed_indices.update(missed_lines)
-                return failed_indices
+_ASS_MARKUP_RE = re.compile(r'\{[^}]*\}|\\[Nnh]')  # override blocks and \N, \n, \h
+_ASS_DRAWING_RE = re.compile(r'\\p(\d+)')
+_ASS_LINE_BREAK_RE = re.compile(r'(?:\\[Nnh])+')
+_ASS_PLACEHOLDER_RE = re.compile(r'\{(\d+)\}')
 
-            # 2) Index comparison
-            if translated_idx_from_block == original_idx:
-                # Match - take the translation (without the first line)
-                translated_text_block = '\n'.join(lines_in_block[1:])
-                translated_subs[original_idx] = translated_text_block
-                processed_indices.add(original_idx)
+def mask_ass_text(text: str) -> Optional[Tuple[str, str, List[str], str]]:
+    """
+    Splits the Text field of an ASS event into markup and translatable text.
+    Returns (prefix, masked, tags, suffix): override blocks at the start and at the end go to prefix/suffix,
+    markup in the middle is replaced with placeholders {1}, {2}, ... (tags[0], tags[1], ...).
+    Vector drawings ({\p1}...{\p0}) are markup as well.
+    Returns None if there is nothing to translate (drawing-only or tag-only event).
+    """
+    pieces = []  # (is_markup, text)
+    drawing = False
+    pos = 0
+    for match in _ASS_MARKUP_RE.finditer(text):
+        if match.start() > pos:
+            pieces.append((drawing, text[pos:match.start()]))
+        tag = match.group()
+        modes = _ASS_DRAWING_RE.findall(tag) if tag.startswith('{') else None
+        if modes:
+            drawing = int(modes[-1]) > 0
+        pieces.append((True, tag))
+        pos = match.end()
+    if pos < len(text):
+        pieces.append((drawing, text[pos:]))
+
+    text_positions = [i for i, (is_markup, piece) in enumerate(pieces) if not is_markup and piece.strip()]
+    if not text_positions:
+        return None
 
-                original_idx = next(chunk_indices_iter, None)
-                tb_index += 1
+    first, last = text_positions[0], text_positions[-1]
+    prefix = ''.join(piece for _, piece in pieces[:first])
+    suffix = ''.join(piece for _, piece in pieces[last + 1:])
+    masked = []
+    tags = []
+    for is_markup, piece in pieces[first:last + 1]:
+        if not is_markup:
+            masked.append(piece)
+        elif masked and masked[-1] == '{%d}' % len(tags):
+            tags[-1] += piece  # adjacent markup goes into one placeholder
+        else:
+            tags.append(piece)
+            masked.append('{%d}' % len(tags))
+    return prefix, ''.join(masked), tags, suffix
 
-            else:
-                # Any mismatch -> "index error"
-                # Need to add ALL remaining lines to skipped
-                tail_index_pos = chunk.indices.index(original_idx)
-                missed_lines = chunk.indices[tail_index_pos:]
-                failed_indices.update(missed_lines)
-                return failed_indices
+def unmask_ass_text(translation: str, mask: Tuple[str, str, List[str], str]) -> str:
+    """
+    Puts the markup saved by mask_ass_text back into the translation.
+    Placeholders lost by the model are re-inserted after the leading tags (line breaks are dropped instead),
+    unknown or repeated placeholders are removed.
+    """
+    prefix, _, tags, suffix = mask
+    used = set()
+
+    def restore(match) -> str:
+        n = int(match.group(1)) - 1
+        if 0 <= n < len(tags) and n not in used:
+            used.add(n)
+            return tags[n]
+        return ''
+
+    text = _ASS_PLACEHOLDER_RE.sub(restore, translation.strip()).replace('\n', '\\N')
+    missing = ''.join(tag for n, tag in enumerate(tags) if n not in used and not _ASS_LINE_BREAK_RE.fullmatch(tag))
+    return prefix + missing + text + suffix
+
+JSON_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "items": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "id": {"type": "INTEGER"},
+                    "text": {"type": "STRING"}
+                },
+                "required": ["id", "text"]
+            }
+        }
+    },
+    "required": ["items"]
+}
 
-        # If original indices are left at the end of the loop,
-        # it means they were not translated - also mark as skipped
-        while original_idx is not None:
-            failed_indices.add(original_idx)
-            original_idx = next(chunk_indices_iter, None)
+def is_json_output(settings: Dict) -> bool:
+    return settings.get('output_format', 'text') == 'json'
 
-    except Exception as e:
-        # Any error - all lines of the chunk go to skipped
-        failed_indices.update(chunk.indices)
-        logger.error(f"Chunk translation error ({attempt_type}): {str(e)}")
-        logger.exception("Error details:")
+def build_instructions(settings: Dict) -> str:
+    """
+    Static translation rules, the same for every chunk of every file. They are sent first
+    (DeepSeek system message, Gemini systemInstruction), so providers can serve them from the prompt cache.
+    With output_format=json the model is asked for {"items": [{"id": N, "text": "..."}]} instead of blocks.
+    """
+    if is_json_output(settings):
+        structure_rules = (
+            "1. Reply with JSON only: {\"items\": [{\"id\": <block number>, \"text\": \"<translation>\"}]}\n"
+            "2. One item for every block, id is the number in the first line of the block\n"
+            "3. Do not merge or split blocks, text is the translation of the block without its number\n"
+            "4. Do not add new lines and symbols\n"
+        )
+    else:
+        structure_rules = (
+            "1. Keep the original line numbers unchanged\n"
+            "2. Do not change the structure of blocks and the order of lines\n"
+            "3. The first line of a block is always just a number\n"
+            "4. Do not add new lines and symbols\n"
+        )
+    return (
+        f"Perform a literary translation into {settings['target_language']} strictly adhering to:\n"
+        f"{structure_rules}"
+        "5. Keep special constructions (e.g., ♪) as is\n"
+        "6. Consider the context of the entire text as if there were no line breaks and line numbering\n"
+        "7. Do not change HTML tags (but translate the text inside the tags considering the overall context)\n"
+        "8. For ambiguous expressions and words, choose a contextually appropriate translation\n"
+        "9. Do not translate Latin\n"
+        "10. Keep placeholders in curly braces (e.g., {1}) unchanged and in place"
+    )
+
+def build_file_section(file_context: str) -> str:
+    return (
+        "Source text of the whole file (read only, for reference). Translate only the lines given below.\n"
+        f"{file_context}\n\n"
+    )
+
+def build_prompt(text: str, context: str = '', file_context: str = '') -> str:
+    """
+    Builds the variable part of a request for a chunk of numbered blocks, the same for all providers.
+    The whole source file (file_context, same for all chunks of a file) goes first so it stays a cacheable prefix,
+    then the read-only context (see format_context), then the text to translate.
+    """
+    file_section = build_file_section(file_context) if file_context else ''
+    context_section = (
+        "Context (read only): neighbouring lines, \"=>\" marks their existing translation. "
+        "Do not translate them and do not include them in the reply.\n"
+        f"{context}\n\n"
+    ) if context else ''
+    if not file_section and not context_section:
+        return text
+    return f"{file_section}{context_section}Text to translate:\n{text}"
+
+def parse_json_translation(reply: str) -> Optional[Dict[int, str]]:
+    """
+    Parses a structured (output_format=json) reply into {block number: translation}.
+    Accepts {"items": [...]}, a bare list of items or a {"number": "text"} object.
+    Returns None if the reply is not valid JSON of one of these shapes.
+    """
+    reply = reply.strip()
+    if reply.startswith('```'):
+        # Some models wrap JSON into a markdown code block anyway
+        reply = reply.strip('`')
+        if reply.startswith('json'):
+            reply = reply[4:]
+    try:
+        data = json.loads(reply)
+    except ValueError:
+        logger.warning("Structured reply is not valid JSON")
+        return None
 
-    return failed_indices
+    if isinstance(data, dict) and isinstance(data.get('items'), list):
+        data = data['items']
+    if isinstance(data, dict):
+        data = [{'id': key, 'text': value} for key, value in data.items()]
+    if not isinstance(data, list):
+        logger.warning("Structured reply has an unexpected shape")
+        return None
 
-def translate_text_deepseek(text: str, settings: Dict) -> Optional[str]:
-    api_key = get_api_key(settings)
-    if not api_key:
-        return None  # No API key - exiting
+    result = {}
+    for item in data:
+        if not isinstance(item, dict) or not isinstance(item.get('text'), str):
+            continue
+        try:
+            number = int(item.get('id'))
+        except (TypeError, ValueError):
+            continue
+        result.setdefault(number, item['text'])
+    return result
 
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {api_key}'
-    }
+def iter_sse_events(response) -> Iterator[Dict]:
+    """
+    Yields JSON payloads of a server-sent events stream ("data: {...}" lines).
+    """
+    response.encoding = 'utf-8'
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith('data:'):
+            continue
+        payload = line[5:].strip()
+        if payload == '[DONE]':
+            break
+        yield json.loads(payload)
 
+def deepseek_request_data(text: str, settings: Dict, context: str = '') -> Dict:
+    """
+    Body of a DeepSeek chat completion request (also used as the body of batch requests).
+    The rules and the source file come first and do not change between chunks,
+    so DeepSeek serves this prefix from its context cache.
+    """
     # Use the selected model from settings (deepseek-chat or deepseek-reasoner)
     chosen_model = settings.get('deepseek_model', 'deepseek-chat')
-
     data = {
         "model": chosen_model,  #  Get model name from settings
         "messages": [
+            {
+                "role": "system",
+                "content": build_instructions(settings)
+            },
             {
                 "role": "user",
-                "content": (
-                    f"Perform a literary translation into {settings['target_language']} strictly adhering to:\n"
-                        "1. Keep the original line numbers unchanged\n"
-                        "2. Do not change the structure of blocks and the order of lines\n"
-                        "3. The first line of a block is always just a number\n"
-                        "4. Do not add new lines and symbols\n"
-                        "5. Keep special constructions (e.g., ♪) as is\n"
-                        "6. Consider the context of the entire text as if there were no line breaks and line numbering\n"
-                        "7. Do not change HTML tags (but translate the text inside the tags considering the overall context)\n"
-                        "8. For ambiguous expressions and words, choose a contextually appropriate translation\n"
-                        "9. Do not translate Latin\n\n"
-                    f"{text}"
-                )
+                "content": build_prompt(text, context, settings.get('_file_context', ''))
             }
-        ],
-        "stream": False  # Disable streaming mode
+        ]
     }
+    if is_json_output(settings):
+        data["response_format"] = {"type": "json_object"}
+    return data
 
-    try:
-        timeout_value = int(settings.get('timeout', 360))
-        response = requests.post(
-            DEEPSEEK_API_URL,
-            headers=headers,
-            data=json.dumps(data),
-            timeout=timeout_value
-        )
-        response.raise_for_status()
-        response_json = response.json()
-
-        logger.debug(f"DeepSeek API Response (JSON):\n{json.dumps(response_json, indent=2, ensure_ascii=False)}")
-
-        if 'choices' in response_json and response_json['choices']:
-            message = response_json['choices'][0].get('message')
-            if message and 'content' in message:
-                return message['content']
-            else:
-                logger.error(f"DeepSeek API: No content in response: {response_json}")
-                return None
-        else:
-            logger.error(f"DeepSeek API: Unexpected response structure: {response_json}")
-            return None
-
-    except requests.exceptions.RequestException as e:
-        logger.error(f"DeepSeek API Request Error: {e}")
-        return None
-    except Exception as e:
-        logger.error(f"DeepSeek API Error: {str(e)}")
-        logger.exception("DeepSeek API Exception details:")
-        return None
-
-def translate_text_gemini(text: str, settings: Dict) -> Optional[str]:
-    api_key = get_api_key(settings)
-    if not api_key:
-        return None
-
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    params = {
-        'key': api_key
-    }
+def gemini_request_data(text: str, settings: Dict, context: str = '') -> Dict:
+    """
+    Body of a Gemini generateContent request (also used for batch requests).
+    With a cachedContents entry of the file (settings['_gemini_cache']) the rules and the source file
+    are taken from the cache, otherwise they are sent as systemInstruction and the start of the text.
+    """
+    cached_content = settings.get('_gemini_cache')
+    file_context = '' if cached_content else settings.get('_file_context', '')
     data = {
         "contents": [{
+            "role": "user",
             "parts": [
                 {
-                    "text": (
-                        f"Perform a literary translation into {settings['target_language']} strictly adhering to:\n"
-                        "1. Keep the original line numbers unchanged\n"
-                        "2. Do not change the structure of blocks and the order of lines\n"
-                        "3. The first line of a block is always just a number\n"
-                        "4. Do not add new lines and symbols\n"
-                        "5. Keep special constructions (e.g., ♪) as is\n"
-                        "6. Consider the context of the entire text as if there were no line breaks and line numbering\n"
-                        "7. Do not change HTML tags (but translate the text inside the tags considering the overall context)\n"
-                        "8. For ambiguous expressions and words, choose a contextually appropriate translation\n"
-                        "9. Do not translate Latin\n\n"
-                        f"{text}"
-                    )
+                    "text": build_prompt(text, context, file_context)
                 }
             ]
         }],
@@ -808,18 +1797,228 @@ def translate_text_gemini(text: str, settings: Dict) -> Optional[str]:
             }
         ]
     }
+    if cached_content:
+        data["cachedContent"] = cached_content
+    else:
+        data["systemInstruction"] = {"parts": [{"text": build_instructions(settings)}]}
+    if is_json_output(settings):
+        data["generationConfig"] = {
+            "responseMimeType": "application/json",
+            "responseSchema": JSON_RESPONSE_SCHEMA
+        }
+    return data
+
+def create_gemini_cache(settings: Dict) -> Optional[str]:
+    """
+    Creates a Gemini cachedContents entry with the rules and the source file (settings['_file_context']),
+    returns its name or None if the file is too small to be cached or the cache could not be created.
+    """
+    instructions = build_instructions(settings)
+    file_section = build_file_section(settings['_file_context'])
+    estimate = get_token_estimator(settings)
+    if estimate(instructions) + estimate(file_section) < GEMINI_CACHE_MIN_TOKENS:
+        return None
+    data = {
+        "model": f"models/{settings['gemini_model']}",
+        "systemInstruction": {"parts": [{"text": instructions}]},
+        "contents": [{"role": "user", "parts": [{"text": file_section}]}],
+        "ttl": f"{GEMINI_CACHE_TTL}s"
+    }
+    try:
+        response = get_http_session(settings).post(
+            f"{GEMINI_API_BASE_URL}/cachedContents",
+            headers={'Content-Type': 'application/json'},
+            params={'key': get_api_key(settings)},
+            data=json.dumps(data),
+            timeout=int(settings.get('timeout', 360))
+        )
+        response.raise_for_status()
+        name = response.json()['name']
+        logger.info(f"Gemini context cache created: {name}")
+        return name
+    except Exception as e:
+        logger.warning(f"Gemini context cache was not created, the file is sent with every request: {str(e)}")
+        return None
+
+def delete_gemini_cache(settings: Dict, name: str):
+    try:
+        get_http_session(settings).delete(f"{GEMINI_API_BASE_URL}/{name}", params={'key': get_api_key(settings)},
+                                          timeout=int(settings.get('timeout', 360)))
+    except Exception as e:
+        logger.warning(f"Gemini context cache {name} was not deleted (expires in {GEMINI_CACHE_TTL} s): {str(e)}")
+
+def open_file_context(subtitles: List[str], settings: Dict) -> Dict:
+    """
+    With file_context=1 returns a copy of settings with the whole source file (numbered like the chunks)
+    in '_file_context' and, for Gemini, the name of its context cache in '_gemini_cache'.
+    """
+    if not settings.get('file_context', 0):
+        return settings
+    file_settings = dict(settings, _file_context='\n\n'.join(f"{idx + 1}\n{text}" for idx, text in enumerate(subtitles)))
+    # Batch requests may run after the file is done, an explicit cache would be deleted by then
+    if settings['api_provider'] == 'gemini' and settings.get('_batch') is None:
+        cache_name = create_gemini_cache(file_settings)
+        if cache_name:
+            file_settings['_gemini_cache'] = cache_name
+    return file_settings
+
+def close_file_context(settings: Dict):
+    if settings.get('_gemini_cache'):
+        delete_gemini_cache(settings, settings['_gemini_cache'])
+
+def notify_request_start(settings: Dict):
+    """
+    Calls settings['_on_request_start'] (set by translate_chunk) once the rate limiter has let the request through,
+    so chunk latencies do not include rate limit waits.
+    """
+    callback = settings.get('_on_request_start')
+    if callback is not None:
+        callback()
+
+def translate_text_deepseek(text: str, settings: Dict,
+                            on_delta: Optional[Callable[[str], bool]] = None,
+                            context: str = '') -> str:
+    """
+    Sends text to DeepSeek and returns the reply, raises ProviderError if the request failed.
+    """
+    api_key = get_api_key(settings)
+    if not api_key:
+        raise ProviderError(ProviderError.AUTH, "DeepSeek API key not found")
+
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {api_key}'
+    }
+
+    stream = bool(settings.get('stream', 0))
+    data = deepseek_request_data(text, settings, context)
+    data["stream"] = stream
 
+    limiter = get_rate_limiter(settings)
+    try:
+        timeout_value = int(settings.get('timeout', 360))
+        estimate = get_token_estimator(settings)
+        # input + output of about the same size, plus context and the file
+        limiter.acquire(estimate(text) * 2 + estimate(context) + estimate(settings.get('_file_context', '')))
+        notify_request_start(settings)
+        response = get_http_session(settings).post(
+            DEEPSEEK_API_URL,
+            headers=headers,
+            data=json.dumps(data),
+            timeout=timeout_value,
+            stream=stream
+        )
+        if not response.ok:
+            raise http_error("DeepSeek", response, limiter)
+        limiter.success()
+
+        if stream:
+            # Closing the response drops the connection if the stream is aborted early
+            with response:
+                parts = []
+                for event in iter_sse_events(response):
+                    choices = event.get('choices') or []
+                    delta = (choices[0].get('delta') or {}).get('content') if choices else None
+                    if not delta:
+                        continue
+                    parts.append(delta)
+                    if on_delta is not None and not on_delta(delta):
+                        logger.warning("DeepSeek API: stream aborted (translation numbering diverged or request cancelled)")
+                        break
+            if not parts:
+                raise ProviderError(ProviderError.MALFORMED, "DeepSeek API: Empty streamed response")
+            return ''.join(parts)
+
+        try:
+            response_json = response.json()
+        except ValueError:
+            raise ProviderError(ProviderError.MALFORMED, f"DeepSeek API: Reply is not JSON: {response.text[:300]}")
+
+        logger.debug(f"DeepSeek API Response (JSON):\n{json.dumps(response_json, indent=2, ensure_ascii=False)}")
+
+        if 'choices' in response_json and response_json['choices']:
+            message = response_json['choices'][0].get('message')
+            if message and message.get('content'):
+                return message['content']
+            else:
+                raise ProviderError(ProviderError.MALFORMED, f"DeepSeek API: No content in response: {response_json}")
+        else:
+            raise ProviderError(ProviderError.MALFORMED, f"DeepSeek API: Unexpected response structure: {response_json}")
+
+    except ProviderError:
+        raise
+    except requests.exceptions.RequestException as e:
+        raise ProviderError(ProviderError.NETWORK, f"DeepSeek API Request Error: {e}")
+    except Exception as e:
+        logger.exception("DeepSeek API Exception details:")
+        raise ProviderError(ProviderError.MALFORMED, f"DeepSeek API Error: {str(e)}")
+
+def translate_text_gemini(text: str, settings: Dict,
+                          on_delta: Optional[Callable[[str], bool]] = None,
+                          context: str = '') -> str:
+    """
+    Sends text to Gemini and returns the reply, raises ProviderError if the request failed.
+    """
+    api_key = get_api_key(settings)
+    if not api_key:
+        raise ProviderError(ProviderError.AUTH, "Gemini API key not found")
+
+    headers = {
+        'Content-Type': 'application/json'
+    }
+    params = {
+        'key': api_key
+    }
+    stream = bool(settings.get('stream', 0))
+    if stream:
+        params['alt'] = 'sse'
+    method = 'streamGenerateContent' if stream else 'generateContent'
+    data = gemini_request_data(text, settings, context)
+
+    limiter = get_rate_limiter(settings)
     try:
         timeout_value = int(settings.get('timeout', 360)) 
-        response = requests.post(
-            f"https://generativelanguage.googleapis.com/v1beta/models/{settings['gemini_model']}:generateContent",
+        estimate = get_token_estimator(settings)
+        # input + output of about the same size, plus context and the file (unless it is in the context cache)
+        file_tokens = 0 if settings.get('_gemini_cache') else estimate(settings.get('_file_context', ''))
+        limiter.acquire(estimate(text) * 2 + estimate(context) + file_tokens)
+        notify_request_start(settings)
+        response = get_http_session(settings).post(
+            f"https://generativelanguage.googleapis.com/v1beta/models/{settings['gemini_model']}:{method}",
             headers=headers,
             params=params,
             data=json.dumps(data),
-            timeout=timeout_value
+            timeout=timeout_value,
+            stream=stream
         )
-        response.raise_for_status()
-        response_json = response.json()
+        if not response.ok:
+            raise http_error("Gemini", response, limiter)
+        limiter.success()
+
+        if stream:
+            # Closing the response drops the connection if the stream is aborted early
+            with response:
+                parts = []
+                for event in iter_sse_events(response):
+                    for candidate in event.get('candidates', [])[:1]:
+                        if candidate.get('finishReason') == 'SAFETY':
+                            raise ProviderError(ProviderError.SAFETY, "Gemini API blocked content due to safety policy.")
+                        for part in (candidate.get('content') or {}).get('parts', []):
+                            delta = part.get('text')
+                            if not delta or part.get('thought'):
+                                continue
+                            parts.append(delta)
+                            if on_delta is not None and not on_delta(delta):
+                                logger.warning("Gemini API: stream aborted (translation numbering diverged or request cancelled)")
+                                return ''.join(parts)
+            if not parts:
+                raise ProviderError(ProviderError.MALFORMED, "Gemini API: Empty streamed response")
+            return ''.join(parts)
+
+        try:
+            response_json = response.json()
+        except ValueError:
+            raise ProviderError(ProviderError.MALFORMED, f"Gemini API: Reply is not JSON: {response.text[:300]}")
 
         logger.debug(f"Gemini API Response (JSON):\n{json.dumps(response_json, indent=2, ensure_ascii=False)}")
 
@@ -830,113 +2029,595 @@ def translate_text_gemini(text: str, settings: Dict) -> Optional[str]:
                 safety_details = ", ".join(
                     [f"{rating['category']}: {rating['probability']}" for rating in safety_ratings]
                 )
-                logger.warning(f"Gemini API blocked content due to safety policy. Details: {safety_details}")
-                return None
+                raise ProviderError(ProviderError.SAFETY,
+                                    f"Gemini API blocked content due to safety policy. Details: {safety_details}")
 
             if 'content' in candidate and candidate['content']['parts']:
-                text_result = candidate['content']['parts'][0]['text']
+                text_result = candidate['content']['parts'][0].get('text')
                 if text_result is None:
-                    raise Exception("Gemini API returned None text in response")
+                    raise ProviderError(ProviderError.MALFORMED, "Gemini API returned None text in response")
                 return text_result
 
-        logger.error(f"Gemini API response structure error: {response_json}")
-        raise Exception("Unexpected structure from Gemini API")
-
-    except requests.exceptions.HTTPError as e:
-        logger.error(f"Gemini API HTTP Error: {e}")
-        if e.response is not None:
-            logger.error(f"Response status code: {e.response.status_code}")
-            logger.error(f"Response body: {e.response.text}")
-        return None
+        block_reason = (response_json.get('promptFeedback') or {}).get('blockReason')
+        if block_reason:
+            raise ProviderError(ProviderError.SAFETY, f"Gemini API blocked the prompt: {block_reason}")
+        raise ProviderError(ProviderError.MALFORMED, f"Gemini API response structure error: {response_json}")
 
+    except ProviderError:
+        raise
+    except requests.exceptions.RequestException as e:
+        raise ProviderError(ProviderError.NETWORK, f"Gemini API Request Error: {e}")
     except Exception as e:
-        logger.error(f"Gemini API Error: {str(e)}")
         logger.exception("Gemini API Exception details:")
-        return None
+        raise ProviderError(ProviderError.MALFORMED, f"Gemini API Error: {str(e)}")
+
+
+class Backend:
+    """
+    One provider/model pair of the router with its observed performance:
+    EWMA of seconds per token and of the error rate, and the number of requests in flight.
+    """
+    EWMA_ALPHA = 0.3
+
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        self.seconds_per_token: Optional[float] = None  # None - no successful requests yet
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.disabled = False  # after an auth/config error
+
+    @property
+    def name(self) -> str:
+        return f"{self.provider}:{self.model}"
+
+    def settings_for(self, settings: Dict) -> Dict:
+        backend_settings = dict(settings, api_provider=self.provider, **{f'{self.provider}_model': self.model})
+        if self.provider == 'gemini' and self.model != settings.get('gemini_model'):
+            backend_settings.pop('_gemini_cache', None)  # the context cache belongs to another model
+        return backend_settings
+
+    def expected_seconds(self, settings: Dict, tokens: int) -> float:
+        """
+        Expected time to get a good reply: rate limiter wait plus latency, stretched by
+        requests already in flight and by the share of failed requests.
+        """
+        wait = get_rate_limiter(self.settings_for(settings)).expected_wait(tokens)
+        latency = (self.seconds_per_token or 0.0) * tokens * (1 + self.in_flight)
+        return (wait + latency) / max(0.05, 1 - self.error_rate)
+
+    def record(self, ok: bool, seconds: float, tokens: int):
+        self.requests += 1
+        self.error_rate += self.EWMA_ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+        if ok:
+            sample = seconds / max(1, tokens)
+            if self.seconds_per_token is None:
+                self.seconds_per_token = sample
+            else:
+                self.seconds_per_token += self.EWMA_ALPHA * (sample - self.seconds_per_token)
+        else:
+            self.errors += 1
+
+class BackendRouter:
+    """
+    Sends every request to the backend (see Backend) with the lowest expected time,
+    so several providers and models work at the same time and slow or throttled ones get less traffic.
+    Backends without requests yet are tried first. A failed request is repeated once on every other backend,
+    unless part of the reply was already streamed. Backends with an auth/config error are disabled
+    and backends with an open circuit breaker are skipped while others are available.
+    """
+    def __init__(self, backends: List[Backend]):
+        self.backends = backends
+        self.lock = threading.Lock()
+
+    def _pick(self, settings: Dict, tokens: int, tried: Set[str]) -> Optional[Backend]:
+        with self.lock:
+            candidates = [b for b in self.backends if b.name not in tried and not b.disabled]
+            if not candidates:
+                return None
+            closed = [b for b in candidates if not get_circuit_breaker(b.settings_for(settings)).is_open()]
+            # With every breaker open the request waits for a cooldown (see CircuitBreaker.check)
+            candidates = closed or candidates
+            backend = min(candidates, key=lambda b: b.expected_seconds(settings, tokens))
+            backend.in_flight += 1
+            return backend
+
+    def translate(self, text: str, settings: Dict,
+                  on_delta: Optional[Callable[[str], bool]] = None,
+                  context: str = '') -> str:
+        tokens = get_token_estimator(settings)(text) * 2
+        streamed = False
+
+        def relay(delta: str) -> bool:
+            nonlocal streamed
+            streamed = True
+            return on_delta(delta)
+
+        tried: Set[str] = set()
+        errors: List[ProviderError] = []
+        while True:
+            backend = self._pick(settings, tokens, tried)
+            if backend is None:
+                if not errors:
+                    raise ProviderError(ProviderError.CONFIG, "All backends are disabled")
+                # Fatal only if every backend failed with a fatal error
+                raise next((e for e in errors if not e.fatal), errors[-1])
+            tried.add(backend.name)
+            started = time.monotonic()
+            ok = False
+            try:
+                result = translate_text_with_provider(text, backend.settings_for(settings),
+                                                      relay if on_delta is not None else None, context)
+                ok = True
+                return result
+            except ProviderError as e:
+                errors.append(e)
+                if e.kind in (ProviderError.AUTH, ProviderError.CONFIG):
+                    backend.disabled = True
+                    logger.error(f"Backend {backend.name} disabled: {e}")
+                if streamed:
+                    raise
+                logger.warning(f"Backend {backend.name} failed ({e.kind}), trying another one")
+            finally:
+                with self.lock:
+                    backend.in_flight -= 1
+                    backend.record(ok, time.monotonic() - started, tokens)
+
+    def log_stats(self):
+        for b in self.backends:
+            latency = f"{b.seconds_per_token * 1000:.1f} ms/1k tokens" if b.seconds_per_token is not None else "n/a"
+            disabled = " (disabled)" if b.disabled else ""
+            logger.info(f"Backend {b.name}{disabled}: {b.requests} requests, {b.errors} errors, latency {latency}")
+
+def parse_backends(settings: Dict) -> List[Backend]:
+    """
+    Parses settings['backends'] ("gemini:gemini-2.0-flash,deepseek:deepseek-chat", a provider without a model
+    uses the model from settings). Backends of unknown providers or without an API key
+    (in the environment or settings) are skipped.
+    """
+    backends = []
+    for item in settings.get('backends', '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        provider, _, model = item.partition(':')
+        provider = provider.strip().lower()
+        if provider not in ('gemini', 'deepseek'):
+            logger.warning(f"Unknown provider in backends: {item}")
+            continue
+        if not stored_api_key(settings, provider):
+            logger.warning(f"No API key for backend {item}, skipping it")
+            continue
+        backends.append(Backend(provider, model.strip() or settings.get(f'{provider}_model', '')))
+    return backends
 
+_backend_router: Optional[BackendRouter] = None
+_backend_router_lock = threading.Lock()
 
-def translate_text(text: str, settings: Dict) -> Optional[str]:
+def get_backend_router(settings: Dict) -> Optional[BackendRouter]:
+    """
+    Returns the shared router when settings['backends'] lists backends, otherwise None (single provider).
+    Raises ProviderError if backends is set but none of them can be used.
+    """
+    global _backend_router
+    if not settings.get('backends'):
+        return None
+    with _backend_router_lock:
+        if _backend_router is None:
+            backends = parse_backends(settings)
+            if not backends:
+                raise ProviderError(ProviderError.CONFIG,
+                                    f"No usable backend in backends={settings['backends']} (unknown providers or no API keys)")
+            logger.info(f"Load balancing across: {', '.join(b.name for b in backends)}")
+            _backend_router = BackendRouter(backends)
+        return _backend_router
+
+def api_keys_available(settings: Dict) -> bool:
+    """
+    Checks the API keys needed for translation: with backends - that at least one backend is usable
+    (keys from the environment or settings), otherwise the key of api_provider (asked for in interactive mode).
+    """
+    if settings.get('backends'):
+        try:
+            return get_backend_router(settings) is not None
+        except ProviderError as e:
+            logger.error(str(e))
+            return False
+    return bool(get_api_key(settings))
+
+def log_backend_stats():
+    with _backend_router_lock:
+        if _backend_router is not None:
+            _backend_router.log_stats()
+
+def translate_text(text: str, settings: Dict,
+                   on_delta: Optional[Callable[[str], bool]] = None,
+                   context: str = '') -> str:
+    """
+    Sends text to the selected provider, or through the router when several backends are configured.
+    In streaming mode (stream=1) on_delta receives every received piece of the reply
+    and can return False to abort the request early.
+    context is sent as a read-only section that the model does not translate.
+    Raises ProviderError if the request failed.
+    """
+    router = get_backend_router(settings)
+    if router is not None:
+        return router.translate(text, settings, on_delta, context)
+    return translate_text_with_provider(text, settings, on_delta, context)
+
+def translate_text_with_provider(text: str, settings: Dict,
+                                 on_delta: Optional[Callable[[str], bool]] = None,
+                                 context: str = '') -> Optional[str]:
+    """
+    Sends text to the provider of settings through its circuit breaker (see CircuitBreaker).
+    """
     api_provider = settings['api_provider']
     if api_provider == 'deepseek':
-        return translate_text_deepseek(text, settings)
+        send = translate_text_deepseek
     elif api_provider == 'gemini':
-        return translate_text_gemini(text, settings)
+        send = translate_text_gemini
     else:
         logger.error(f"Unknown API provider: {api_provider}")
         raise ValueError(f"Unknown API provider: {api_provider}")
 
-def create_chunks(indices: Set[int], subtitles: List[str], settings: Dict, overlap: int = 10) -> List[ChunkInfo]:
+    breaker = get_circuit_breaker(settings)
+    breaker.check()
+    try:
+        result = send(text, settings, on_delta, context)
+    except ProviderError as e:
+        breaker.failure(e)
+        raise
+    breaker.success()
+    return result
+
+def context_indices_for(sorted_indices: List[int], overlap: int) -> List[int]:
+    """
+    Returns up to 'overlap' lines before every line of sorted_indices that are not in sorted_indices themselves.
+    """
+    context = []
+    previous = -1
+    for idx in sorted_indices:
+        context.extend(range(max(previous + 1, idx - overlap), idx))
+        previous = idx
+    return context
+
+def format_context(context_indices: List[int],
+                   subtitles: List[str],
+                   translated_subs: Optional[List[str]] = None,
+                   pending: Set[int] = frozenset()) -> str:
+    """
+    Formats context lines as numbered blocks, lines that are already translated
+    (translated_subs is given and the line is not in pending) get their translation after "=>".
+    """
+    blocks = []
+    for idx in context_indices:
+        block = f"{idx + 1}\n{subtitles[idx]}"
+        if translated_subs is not None and idx not in pending:
+            block += f"\n=> {translated_subs[idx]}"
+        blocks.append(block)
+    return '\n\n'.join(blocks)
+
+def gemini_reply_text(response_json: Dict) -> Optional[str]:
+    """
+    Text of a Gemini generateContent response, None if it was blocked or has no text.
+    """
+    candidates = (response_json or {}).get('candidates') or []
+    if not candidates:
+        return None
+    candidate = candidates[0]
+    if candidate.get('finishReason') == 'SAFETY':
+        logger.warning("Gemini API blocked content due to safety policy.")
+        return None
+    parts = (candidate.get('content') or {}).get('parts') or []
+    text = ''.join(part.get('text', '') for part in parts if not part.get('thought'))
+    return text or None
+
+class BatchJob:
+    """
+    Batch mode (batch=1): chunk requests of all files are collected first, submitted as one provider
+    batch job and polled until it is done, then the files are processed again and translate_chunk
+    maps the batch replies like normal replies. Chunks without a reply are translated as usual.
+    The job name, submitted request keys and received replies are kept in BATCH_STATE_FILE,
+    so an interrupted run continues with the same job instead of submitting a new one.
     """
-    Creates chunks with overlap.
+    def __init__(self, path: str, settings: Dict):
+        self.path = path
+        self.provider = settings['api_provider']
+        self.base_url = (settings.get('batch_api_url') or
+                         (GEMINI_API_BASE_URL if self.provider == 'gemini' else DEEPSEEK_BATCH_URL)).rstrip('/')
+        self.requests: Dict[str, Dict] = {}  # request key (chunk cache key) -> request body
+        self.job: Optional[str] = None
+        self.submitted_keys: List[str] = []
+        self.replies: Dict[str, str] = {}
+        self.collecting = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Batch state {self.path} is unreadable, ignoring it: {e}")
+            return
+        if state.get('provider') != self.provider:
+            return
+        self.job = state.get('job')
+        self.submitted_keys = state.get('keys', [])
+        self.replies = state.get('replies', {})
+
+    def save(self):
+        state = {'provider': self.provider, 'job': self.job, 'keys': self.submitted_keys, 'replies': self.replies}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def add(self, key: str, chunk: ChunkInfo, settings: Dict):
+        with self.lock:
+            if key not in self.requests and key not in self.replies:
+                if self.provider == 'gemini':
+                    self.requests[key] = gemini_request_data(chunk.content, settings, chunk.context)
+                else:
+                    self.requests[key] = deepseek_request_data(chunk.content, settings, chunk.context)
+
+    def reply(self, key: str) -> Optional[str]:
+        return self.replies.get(key)
+
+    def run(self, settings: Dict):
+        """
+        Submits collected requests (or continues the saved job) and waits for the replies.
+        """
+        pending = [key for key in self.requests if key not in self.replies]
+        if not pending:
+            return
+        if self.job and set(pending) <= set(self.submitted_keys):
+            logger.info(f"Continuing batch job {self.job}")
+        else:
+            if self.job:
+                logger.warning(f"Batch job {self.job} does not cover the current requests, submitting a new one")
+            self.job = self._submit(pending, settings)
+            self.submitted_keys = pending
+            self.save()
+            logger.info(f"Batch job {self.job} submitted: {len(pending)} requests")
+
+        interval = max(1, int(settings.get('batch_poll_interval', 30)))
+        while True:
+            replies = self._poll(settings)
+            if replies is not None:
+                break
+            time.sleep(interval)
+        self.replies.update(replies)
+        self.job = None
+        self.submitted_keys = []
+        self.save()
+        logger.info(f"Batch job finished: {len(replies)} of {len(pending)} replies received")
+
+    def _headers(self, settings: Dict) -> Dict:
+        if self.provider == 'gemini':
+            return {'x-goog-api-key': get_api_key(settings)}
+        return {'Authorization': f'Bearer {get_api_key(settings)}'}
+
+    def _submit(self, keys: List[str], settings: Dict) -> str:
+        session = get_http_session(settings)
+        timeout_value = int(settings.get('timeout', 360))
+        if self.provider == 'gemini':
+            # Requests go in an uploaded JSONL file, inline batch bodies are limited to about 20 MB
+            lines = [json.dumps({"key": key, "request": self.requests[key]}, ensure_ascii=False) for key in keys]
+            data = {
+                "batch": {
+                    "display_name": "subtitles",
+                    "input_config": {"file_name": self._upload_gemini_file('\n'.join(lines).encode('utf-8'), settings)}
+                }
+            }
+            response = session.post(f"{self.base_url}/models/{settings['gemini_model']}:batchGenerateContent",
+                                    headers=self._headers(settings), json=data, timeout=timeout_value)
+            response.raise_for_status()
+            return response.json()['name']
+
+        # OpenAI-compatible flow: upload a JSONL file with requests, then create a batch from it
+        lines = [json.dumps({"custom_id": key, "method": "POST", "url": "/v1/chat/completions",
+                             "body": self.requests[key]}, ensure_ascii=False) for key in keys]
+        response = session.post(f"{self.base_url}/files", headers=self._headers(settings),
+                                data={'purpose': 'batch'},
+                                files={'file': ('batch.jsonl', '\n'.join(lines).encode('utf-8'), 'application/jsonl')},
+                                timeout=timeout_value)
+        response.raise_for_status()
+        input_file_id = response.json()['id']
+        response = session.post(f"{self.base_url}/batches", headers=self._headers(settings),
+                                json={"input_file_id": input_file_id, "endpoint": "/v1/chat/completions",
+                                      "completion_window": "24h"},
+                                timeout=timeout_value)
+        response.raise_for_status()
+        return response.json()['id']
+
+    def _gemini_url(self, kind: str, path: str) -> str:
+        # https://host/v1beta -> https://host/upload/v1beta/<path> (or download)
+        root, _, version = self.base_url.rpartition('/')
+        return f"{root}/{kind}/{version}/{path}"
+
+    def _upload_gemini_file(self, content: bytes, settings: Dict) -> str:
+        """
+        Uploads the JSONL input of a Gemini batch through the Files API (resumable upload), returns the file name.
+        """
+        session = get_http_session(settings)
+        timeout_value = int(settings.get('timeout', 360))
+        headers = dict(self._headers(settings), **{
+            'X-Goog-Upload-Protocol': 'resumable',
+            'X-Goog-Upload-Command': 'start',
+            'X-Goog-Upload-Header-Content-Length': str(len(content)),
+            'X-Goog-Upload-Header-Content-Type': 'application/jsonl',
+        })
+        response = session.post(self._gemini_url('upload', 'files'), headers=headers,
+                                json={"file": {"display_name": "subtitles-batch"}}, timeout=timeout_value)
+        response.raise_for_status()
+        upload_url = response.headers['X-Goog-Upload-URL']
+        headers = dict(self._headers(settings), **{
+            'X-Goog-Upload-Command': 'upload, finalize',
+            'X-Goog-Upload-Offset': '0',
+        })
+        response = session.post(upload_url, headers=headers, data=content, timeout=timeout_value)
+        response.raise_for_status()
+        return response.json()['file']['name']
+
+    def _poll(self, settings: Dict) -> Optional[Dict[str, str]]:
+        """
+        Returns {request key: reply} once the job is done, None while it is still running.
+        """
+        session = get_http_session(settings)
+        timeout_value = int(settings.get('timeout', 360))
+        if self.provider == 'gemini':
+            response = session.get(f"{self.base_url}/{self.job}", headers=self._headers(settings), timeout=timeout_value)
+            response.raise_for_status()
+            operation = response.json()
+            state = (operation.get('metadata') or {}).get('state', '')
+            if not operation.get('done'):
+                logger.info(f"Batch job {self.job}: {state or 'running'}")
+                return None
+            if 'error' in operation:
+                raise Exception(f"Batch job {self.job} failed: {operation['error']}")
+            result = operation.get('response') or {}
+            replies = {}
+            if result.get('responsesFile'):
+                response = session.get(self._gemini_url('download', f"{result['responsesFile']}:download"),
+                                       headers=self._headers(settings), params={'alt': 'media'},
+                                       timeout=timeout_value)
+                response.raise_for_status()
+                response.encoding = 'utf-8'
+                for line in response.text.splitlines():
+                    if not line.strip():
+                        continue
+                    item = json.loads(line)
+                    text = gemini_reply_text(item.get('response'))
+                    if item.get('key') and text is not None:
+                        replies[item['key']] = text
+                return replies
+            # Inline responses of jobs submitted with inline requests
+            for item in (result.get('inlinedResponses') or {}).get('inlinedResponses', []):
+                key = (item.get('metadata') or {}).get('key')
+                text = gemini_reply_text(item.get('response'))
+                if key and text is not None:
+                    replies[key] = text
+            return replies
+
+        response = session.get(f"{self.base_url}/batches/{self.job}", headers=self._headers(settings), timeout=timeout_value)
+        response.raise_for_status()
+        batch = response.json()
+        status = batch.get('status', '')
+        if status in ('validating', 'in_progress', 'finalizing', 'cancelling'):
+            logger.info(f"Batch job {self.job}: {status}")
+            return None
+        if not batch.get('output_file_id'):
+            raise Exception(f"Batch job {self.job} {status}: {batch.get('errors')}")
+        response = session.get(f"{self.base_url}/files/{batch['output_file_id']}/content",
+                               headers=self._headers(settings), timeout=timeout_value)
+        response.raise_for_status()
+        response.encoding = 'utf-8'
+        replies = {}
+        for line in response.text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            body = (item.get('response') or {}).get('body') or {}
+            choices = body.get('choices') or []
+            content = (choices[0].get('message') or {}).get('content') if choices else None
+            if item.get('custom_id') and content:
+                replies[item['custom_id']] = content
+        return replies
+
+def build_chunks(sorted_indices: List[int],
+                 subtitles: List[str],
+                 chunk_limit: int,
+                 block_size: Callable[[str], int],
+                 overlap: int = 0,
+                 translated_subs: Optional[List[str]] = None,
+                 pending: Set[int] = frozenset()) -> List[ChunkInfo]:
+    """
+    Splits sorted subtitle indices into chunks of at most chunk_limit (0 - one chunk).
+    Chunks do not overlap: up to 'overlap' preceding lines of every chunk line are attached
+    as read-only context instead (see context_indices_for and format_context).
+
+    Numbered blocks and their sizes are computed once per line (sizes in an array),
+    and the size of the current window is kept as a running sum, so the whole split
+    is linear in the number of lines.
+    """
+    blocks = [f"{idx + 1}\n{subtitles[idx]}" for idx in sorted_indices]
+    if not blocks:
+        return []
+
+    bounds = []  # (start, end) positions of every chunk
+    if chunk_limit == 0:
+        bounds.append((0, len(blocks)))
+    else:
+        sizes = array('q', (block_size(block) for block in blocks))
+        window_start = 0  # first position of the current chunk
+        window_size = 0   # sum of sizes[window_start:pos]
+        for pos in range(len(blocks)):
+            if window_size + sizes[pos] > chunk_limit and pos > window_start:
+                bounds.append((window_start, pos))
+                window_start = pos
+                window_size = 0
+            window_size += sizes[pos]
+        bounds.append((window_start, len(blocks)))
+
+    chunks = []
+    for start, end in bounds:
+        indices = sorted_indices[start:end]
+        context_indices = context_indices_for(indices, overlap) if overlap > 0 else []
+        chunks.append(ChunkInfo(indices=indices,
+                                content='\n\n'.join(blocks[start:end]),
+                                context=format_context(context_indices, subtitles, translated_subs, pending),
+                                context_indices=context_indices))
+    return chunks
+
+def create_chunks(indices: Set[int], subtitles: List[str], settings: Dict, overlap: int = 10,
+                  translated_subs: Optional[List[str]] = None) -> List[ChunkInfo]:
+    """
+    Creates chunks with read-only context.
 
     Args:
         indices: Set of subtitle indices to process.
         subtitles: List of subtitles.
-        settings: Dict - settings dictionary containing chunk_size
-        overlap: Number of lines to overlap between chunks.
+        settings: Dict - settings dictionary containing chunk_size or chunk_tokens
+        overlap: Number of preceding lines sent as context.
+        translated_subs: Current translations, context lines outside of indices are sent with them.
 
     Returns:
         List of ChunkInfo.
     """
-    chunk_size_setting = settings.get('chunk_size', MAX_CHUNK_SIZE) # Get chunk_size from settings
-    if chunk_size_setting == 0: # If chunk_size = 0, do not split into chunks
-        full_content = '\n\n'.join([f"{i+1}\n{subtitles[i]}" for i in sorted(list(indices))])
-        return [ChunkInfo(indices=sorted(list(indices)), content=full_content)]
-
-
-    chunks = []
-    current_chunk = []
-    current_indices = []
-    current_size = 0
-    sorted_indices = sorted(list(indices))  # Convert to list and sort
-
-    for i, idx in enumerate(sorted_indices):
-        sub = f"{idx + 1}\n{subtitles[idx]}"
-        sub_size = len(sub.encode('utf-8')) + 2
-
-        if current_size + sub_size > chunk_size_setting and current_chunk: # Use chunk_size_setting
-            chunks.append(ChunkInfo(
-                indices=current_indices.copy(),
-                content='\n\n'.join(current_chunk)
-            ))
-            # Overlap: start the next chunk 'overlap' lines earlier, but not more lines than available
-            start_overlap = max(0, len(current_indices) - overlap)
-            current_chunk = current_chunk[start_overlap:]
-            current_indices = current_indices[start_overlap:]
-            current_size = sum(len(f"{ind + 1}\n{subtitles[ind]}".encode('utf-8')) + 2 for ind in current_indices)
-
-
-        current_chunk.append(sub)
-        current_indices.append(idx)
-        current_size += sub_size
-
-    if current_chunk:
-        chunks.append(ChunkInfo(
-            indices=current_indices.copy(),
-            content='\n\n'.join(current_chunk)
-        ))
-
-    return chunks
+    chunk_size_setting, block_size = get_chunk_limit(settings) # Get chunk_size/chunk_tokens from settings
+    # If chunk_size = 0, do not split into chunks
+    return build_chunks(sorted(indices), subtitles, chunk_size_setting, block_size, overlap,
+                        translated_subs, indices)
 
 def create_tail_chunks(failed_indices: Set[int],
                        subtitles: List[str],
                        settings: Dict,
-                       overlap: int = 10) -> List[ChunkInfo]:
+                       overlap: int = 10,
+                       translated_subs: Optional[List[str]] = None) -> List[ChunkInfo]:
     """
     Creates chunks for re-translation of "tails" – skipped lines.
     Logic:
       1) Group skipped lines by proximity (if the difference between them is <= overlap).
-      2) For each group, add overlap lines before the start of the group (if possible).
-      3) Cut the result by chunk_size (if > 0).
+      2) Cut each group by chunk_size (if > 0).
+      3) Lines before and between the skipped ones are sent as read-only context
+         with their current translations, only the skipped lines are translated again.
     """
 
     # If there are no skipped lines - return nothing
     if not failed_indices:
         return []
 
-    chunk_size_setting = settings.get('chunk_size', 1900)
+    chunk_size_setting, block_size = get_chunk_limit(settings, default_chunk_size=1900)
     # sort skipped indices
-    sorted_failed = sorted(list(failed_indices))
+    sorted_failed = sorted(failed_indices)
 
     # 1. Group skipped lines
     groups = []
@@ -951,193 +2632,413 @@ def create_tail_chunks(failed_indices: Set[int],
             current_group = [sorted_failed[i]]
     groups.append(current_group)  # last section
 
-    # 2. For each group, create final chunks considering overlap lines "before" the group
+    # 2. Convert every group into one or more chunks depending on chunk size (utf-8 bytes or tokens)
     tail_chunks: List[ChunkInfo] = []
 
     for grp in groups:
-        start_fail = grp[0]
-        end_fail = grp[-1]
-
-        # Calculate from where to start context (overlap lines before the start of the group)
-        coverage_start = max(0, start_fail - overlap)
-        coverage_end = end_fail  # inclusive
-
-        # Collect all TRUE indices for this coverage
-        coverage_indices = list(range(coverage_start, coverage_end + 1))
-
-        # 3. Now need to convert coverage_indices into one or more chunks
-        #    depending on chunk_size_setting.
-        if chunk_size_setting == 0:
-            # No size limit - make one chunk
-            chunk_content = []
-            for idx in coverage_indices:
-                # Format in SRT style (line_number, translation)
-                chunk_content.append(f"{idx + 1}\n{subtitles[idx]}")
-            content_str = "\n\n".join(chunk_content)
-            tail_chunks.append(ChunkInfo(indices=coverage_indices, content=content_str))
-        else:
-            # Limit by chunk size (utf-8 bytes)
-            temp_content = []
-            temp_indices = []
-            current_size = 0
-
-            for idx in coverage_indices:
-                sub_str = f"{idx + 1}\n{subtitles[idx]}"
-                sub_size = len(sub_str.encode('utf-8')) + 2  # +2 for '\n\n'
-                # If it doesn't fit - finalize the previous chunk
-                if current_size + sub_size > chunk_size_setting and temp_content:
-                    # Save accumulated
-                    chunk_str = "\n\n".join(temp_content)
-                    tail_chunks.append(ChunkInfo(indices=temp_indices.copy(), content=chunk_str))
-                    # Start new one
-                    temp_content = []
-                    temp_indices = []
-                    current_size = 0
-
-                # Add line
-                temp_content.append(sub_str)
-                temp_indices.append(idx)
-                current_size += sub_size
-
-            # If something is left in temp_content
-            if temp_content:
-                chunk_str = "\n\n".join(temp_content)
-                tail_chunks.append(ChunkInfo(indices=temp_indices, content=chunk_str))
+        # 3. overlap lines before every skipped line become context
+        tail_chunks.extend(build_chunks(grp, subtitles, chunk_size_setting, block_size, overlap,
+                                        translated_subs, failed_indices))
 
     return tail_chunks
 
+class BlockMapper:
+    """
+    Maps translated "N\ntext" blocks to the original indices of a chunk by their numbers, in one pass,
+    so a reply can be mapped while it is still being streamed and out-of-order blocks are not lost.
+    feed() receives paragraphs of the reply (text between blank lines). A line with a number of the chunk
+    starts a new block if it starts a paragraph, or if it is the next number after the text of the previous
+    block and is followed by text of its own (merged blocks). Other lines belong to the current block
+    (a translation split by blank lines, or a translation that is itself a number).
+    Lines whose number never appears stay unmapped and go to retry.
+    mapped collects lines mapped since the last take_mapped() call (for the checkpoint journal).
+    With stop_on_divergence, MAX_MISMATCHES paragraphs in a row with numbers outside of the chunk
+    mark the reply as diverged and the rest of the chunk is left for retry.
+    """
+    INSTRUCTION_PREFIXES = ("Важно:", "Инструкция:", "Note:", "Important:") # List of instruction prefixes, mixed Russian and English
+    MAX_MISMATCHES = 3
+
+    def __init__(self, chunk: ChunkInfo, subtitles: List[str], translated_subs: List[str],
+                 stop_on_divergence: bool = False):
+        self.chunk = chunk
+        self.subtitles = subtitles
+        self.translated_subs = translated_subs
+        numbers = [idx + 1 for idx in chunk.indices]  # blocks are numbered from 1
+        self.next_number = dict(zip(numbers, numbers[1:]))
+        self.unseen_numbers = set(numbers)
+        self.current = None  # number of the block being collected
+        self.current_lines: List[str] = []
+        self.processed_indices = set()
+        self.mapped: Dict[int, str] = {}
+        self.mismatches = 0
+        self.stop_on_divergence = stop_on_divergence
+        self.diverged = False
+
+    def _assign(self, idx: int, text: str):
+        self.translated_subs[idx] = text
+        self.processed_indices.add(idx)
+        self.mapped[idx] = text
+
+    def _close_block(self):
+        if self.current is None:
+            return
+        idx = self.current - 1
+        text = '\n'.join(line for line in self.current_lines if line.strip())
+        if text or not self.subtitles[idx].strip():
+            self._assign(idx, text)
+        else:
+            logger.warning(f"  Empty translation for block {self.current}, left for retry.")
+        self.current = None
+        self.current_lines = []
+
+    def _block_number(self, lines: List[str], pos: int) -> Optional[int]:
+        line = lines[pos].strip()
+        if not line.isdigit():
+            return None
+        number = int(line)
+        if number not in self.unseen_numbers:
+            return None
+        if pos == 0:
+            return number
+        # Inside a paragraph only a further block counts, a lone number is the translation of the current one
+        if (number == self.next_number.get(self.current) and pos + 1 < len(lines)
+                and any(text.strip() for text in self.current_lines)):
+            return number
+        return None
+
+    def feed(self, block: str) -> bool:
+        """
+        Maps one paragraph of the reply. Returns False once the numbering has diverged.
+        """
+        if self.diverged:
+            return False
+        if not block.strip():
+            return True
+
+        lines = block.strip().split('\n')
+        first_line = lines[0].strip()
+        if first_line.isdigit() and self._block_number(lines, 0) is None:
+            # A number outside of the chunk or a repeated one, the text of this block is not used
+            self._close_block()
+            self.mismatches += 1
+            logger.warning(f"  Unexpected block number {first_line} in translation, skipping block.")
+            if self.stop_on_divergence and self.mismatches >= self.MAX_MISMATCHES:
+                logger.warning("  Numbering of the translation diverged.")
+                self.diverged = True
+                return False
+            return True
+        if any(first_line.startswith(prefix) for prefix in self.INSTRUCTION_PREFIXES):
+            # This is not a subtitle, but clearly a service instruction from the model
+            logger.warning(f"Instruction block skipped: '{first_line}'.")
+            self._close_block()
+            return True
+
+        for pos, line in enumerate(lines):
+            number = self._block_number(lines, pos)
+            if number is not None:
+                self._close_block()
+                self.unseen_numbers.discard(number)
+                self.current = number
+                self.mismatches = 0
+            elif self.current is not None:
+                self.current_lines.append(line)
+            else:
+                logger.warning(f"  Text outside of numbered blocks skipped: '{line.strip()}'.")
+        return True
+
+    def finish(self):
+        """
+        Maps the last collected block, called once the whole reply has been fed.
+        """
+        self._close_block()
+
+    def feed_items(self, items: Dict[int, str]):
+        """
+        Maps a structured reply {block number: translation}, lines without an item stay unmapped.
+        """
+        for idx in self.chunk.indices:
+            text = items.get(idx + 1)
+            if text is not None and (text.strip() or not self.subtitles[idx].strip()):
+                self._assign(idx, text.strip())
+        self.unseen_numbers.clear()
+
+    def take_mapped(self) -> Dict[int, str]:
+        mapped, self.mapped = self.mapped, {}
+        return mapped
+
+    def failed_indices(self) -> Set[int]:
+        failed = set(self.chunk.indices) - self.processed_indices
+        if failed:
+            logger.warning(f"  Lines missing in translation: {len(failed)} of {len(self.chunk.indices)}")
+        return failed
+
 def translate_chunk(chunk: ChunkInfo, settings: Dict, subtitles: List[str], translated_subs: List[str],
-                    attempt_type: str = "initial", overlap: int = 10) -> Set[int]:
+                    attempt_type: str = "initial", overlap: int = 10,
+                    on_mapped: Optional[Callable[[Dict[int, str]], None]] = None,
+                    cancel: Optional[threading.Event] = None, use_slot: bool = True,
+                    started: Optional[threading.Event] = None) -> Set[int]:
     """
     Translates a chunk of subtitles, improved handling of API instructions.
+    Failed requests mark the chunk as failed, fatal ProviderErrors (auth/config) are raised.
+    In streaming mode blocks are mapped as soon as they arrive, on_mapped receives
+    the newly mapped lines, and the request is aborted once the numbering diverges
+    or cancel is set. started is set once the request has passed the request slot and the rate limiter
+    (or the chunk is done). With use_slot=False the caller holds a request slot for this chunk.
+    With output_format=json the reply is parsed as a whole and mapped by block number.
     """
     failed_indices = set()
-    instruction_prefixes = ("Важно:", "Инструкция:", "Note:", "Important:") # List of instruction prefixes, mixed Russian and English
-
-    try:
-        translated_text = translate_text(chunk.content, settings)
-        if translated_text is None:
-            logger.warning(f"Chunk translation ({attempt_type}) failed (API error/safety block).")
-            failed_indices.update(chunk.indices)
-            return failed_indices
+    json_output = is_json_output(settings)
+    mapper = BlockMapper(chunk, subtitles, translated_subs, stop_on_divergence=bool(settings.get('stream', 0)))
+    pending_text = ''
+    fed_text_length = 0
+    stopped_early = False  # the stream was aborted, the reply is incomplete
+
+    def report_mapped():
+        mapped = mapper.take_mapped()
+        if on_mapped is not None and mapped:
+            on_mapped(mapped)
+
+    def on_delta(delta: str) -> bool:
+        nonlocal pending_text, fed_text_length, stopped_early
+        pending_text += delta
+        # Everything before the last blank line consists of complete blocks
+        split_pos = pending_text.rfind('\n\n')
+        if split_pos < 0:
+            return True
+        complete, pending_text = pending_text[:split_pos], pending_text[split_pos + 2:]
+        fed_text_length += split_pos + 2
+        for block in complete.split('\n\n'):
+            if not mapper.feed(block):
+                break
+        report_mapped()
+        stopped_early = mapper.diverged or (cancel is not None and cancel.is_set())
+        return not stopped_early
 
-        translated_blocks = translated_text.strip().split('\n\n')
-        processed_indices = set()
+    request_started = None
 
-        # 1. Preparation: Indices and iterators
-        chunk_indices_iter = iter(chunk.indices) # Iterator for chunk indices
-        original_idx = next(chunk_indices_iter, None) # Current original index, start with the first one
+    def on_request_start():
+        nonlocal request_started
+        request_started = time.monotonic()
+        if started is not None:
+            started.set()
 
-        translated_block_index = 0 # Index of the current translation block
+    cache = get_translation_cache(settings)
+    batch = settings.get('_batch')
+    chunk_key = cache_key('chunk-json' if json_output else 'chunk', chunk.content, settings) if cache or batch else None
 
+    try:
         logger.debug(f"chunk ({attempt_type}): indices {chunk.indices}")
 
-        # 2. Main loop for processing translation blocks
-        while translated_block_index < len(translated_blocks) and original_idx is not None:
-            block = translated_blocks[translated_block_index]
-            block_lines = block.strip().split('\n')
-
-            if not block_lines: #Empty block
-                logger.warning(f"Empty block in translation, skipping.")
-                translated_block_index += 1
-                continue
-
-            first_line = block_lines[0].strip()
-            if not first_line.isdigit(): #First line is not a number
-                is_instruction = False
-                for prefix in instruction_prefixes: #Check for instruction prefix
-                    if first_line.startswith(prefix):
-                        is_instruction = True
+        translated_text = cache.get(chunk_key) if cache else None
+        from_cache = translated_text is not None
+        if not from_cache and batch is not None:
+            if batch.collecting:
+                # First pass of batch mode: only remember the request
+                batch.add(chunk_key, chunk, settings)
+                failed_indices.update(chunk.indices)
+                return failed_indices
+            translated_text = batch.reply(chunk_key)
+        if translated_text is None:
+            with get_request_slots(settings) if use_slot else nullcontext():
+                translated_text = translate_text(chunk.content, dict(settings, _on_request_start=on_request_start),
+                                                 on_delta=None if json_output else on_delta,
+                                                 context=chunk.context)
+                if request_started is not None:
+                    _latency_tracker.add(time.monotonic() - request_started)
+
+        if json_output:
+            items = parse_json_translation(translated_text)
+            if items is None:
+                failed_indices.update(chunk.indices)
+                return failed_indices
+            mapper.feed_items(items)
+        else:
+            # Blocks that were not mapped during streaming (the whole reply without streaming).
+            # After an aborted stream the rest is cut off and the last block may be incomplete, both are dropped
+            if not stopped_early:
+                for block in translated_text[fed_text_length:].strip().split('\n\n'):
+                    if not mapper.feed(block):
                         break
-                if is_instruction: #It's an instruction
-                    logger.warning(f"Instruction block skipped: '{first_line}'.")
-                    translated_block_index += 1 #Skip instruction block, original_idx does not change
-                    continue #Go to the next translation block (without changing original_idx)
-                else: #Not a number and not an instruction - process as translation for current original_idx
-                    logger.warning(f"First line is not a number and not an instruction ('{first_line}'), block processed entirely as translation for current original_idx={original_idx}.")
-                    #Consider the whole block as translation for the current original_idx
-                    translated_text_block = block #Whole block, including the "non-number" in the first line
-                    translated_subs[original_idx] = translated_text_block
-                    processed_indices.add(original_idx)
-                    original_idx = next(chunk_indices_iter, None) #Go to the next original_idx
-                    translated_block_index += 1 #Go to the next translation block
-                    continue
-
-
-            translated_idx_from_block = int(first_line) - 1 #Number from translation block
-
-            if translated_idx_from_block == original_idx:
-                # 3. Case 1: Perfect index match (1:1)
-                translated_text_block = '\n'.join(block_lines[1:]) #Translation - all lines except the first one (with number)
-                translated_subs[original_idx] = translated_text_block
-                processed_indices.add(original_idx)
-                logger.debug(f"  1:1 Match: original_idx={original_idx}, translated_idx={translated_idx_from_block}")
-
-                original_idx = next(chunk_indices_iter, None) #Go to the next original_idx
-                translated_block_index += 1 #Go to the next translation block
-
-
-            elif translated_idx_from_block < original_idx:
-                # 4. Case 2: "Extra" block in translation (translation index LESS than original index)
-                logger.warning(f"  Extra block in translation (translated_idx={translated_idx_from_block} < original_idx={original_idx}), skipping block.")
-                translated_block_index += 1 #Skip "extra" block, but do not change original_idx
-
-
-            elif translated_idx_from_block > original_idx:
-                # 5. Case 3: "Skipped" subtitle in translation (translation index GREATER than original index)
-                logger.warning(f"  Skipped subtitle in translation (translated_idx={translated_idx_from_block} > original_idx={original_idx}), filling with original.")
-                #Fill translated_subs[original_idx] with original text (or you can use empty string if needed)
-                translated_subs[original_idx] = subtitles[original_idx] #Original text
-                processed_indices.add(original_idx) #Mark as "processed" (even if not translated)
-
-                original_idx = next(chunk_indices_iter, None) #Go to the next original_idx, do not touch translation block as it "doesn't fit"
-
-            else: #default case - shouldn't happen, but for safety
-                logger.error(f"  Unexpected situation during matching: translated_idx={translated_idx_from_block}, original_idx={original_idx}. Skipping block.")
-                translated_block_index += 1 #Skip translation block
-
-
-        # 6. Processing "tail" of original subtitles (if there are unmapped original_idx left)
-        while original_idx is not None:
-            failed_indices.add(original_idx) #Mark remaining as untranslated
-            logger.warning(f"  Unhandled original tail: original_idx={original_idx}")
-            original_idx = next(chunk_indices_iter, None)
+                mapper.finish()
+        report_mapped()
 
+        failed_indices.update(mapper.failed_indices())
 
-        failed_indices.update(set(chunk.indices) - processed_indices)
+        # Only complete, fully aligned replies are cached, otherwise a re-run would replay the same misalignment
+        if cache and not from_cache and not failed_indices and not stopped_early:
+            entries = [(chunk_key, translated_text)]
+            entries.extend((cache_key('line', subtitles[idx], settings), translated_subs[idx])
+                           for idx in chunk.indices if subtitles[idx].strip())
+            cache.put_many(entries)
 
 
+    except ProviderError as e:
+        if e.fatal:
+            raise  # retrying can not help, the file is aborted
+        logger.warning(f"Chunk translation ({attempt_type}) failed ({e.kind}): {e}")
+        failed_indices.update(chunk.indices)
     except Exception as e:
         logger.error(f"Chunk translation error ({attempt_type}): {str(e)}")
         failed_indices.update(chunk.indices)
         logger.exception("Error details:") #Full error traceback
-
+    finally:
+        if started is not None:
+            started.set()
 
     return failed_indices
 
-def initial_translation(chunks: List[ChunkInfo], settings: Dict, subtitles: List[str], translated_subs: List[str]) -> Set[int]:
+def translate_chunk_hedged(chunk: ChunkInfo, settings: Dict, subtitles: List[str],
+                           attempt_type: str = "initial") -> Tuple[Dict[int, str], Set[int]]:
     """
-    Performs initial translation of subtitles.
+    Translates a chunk like translate_chunk and returns (mapped lines, failed indices).
+    When the request takes longer than the hedge_percentile of the observed chunk latencies,
+    a duplicate request is sent (with backends - usually to another backend, as the first one is busy).
+    The first fully aligned reply wins and the other request is cancelled: a streaming
+    request is aborted, a non-streaming one is left to finish and its reply is dropped.
+    The duplicate needs a request slot, so the global concurrency cap holds: it is sent as soon as a slot
+    frees up (usually once the other chunks are done), unless the original finishes first.
+    Time spent waiting for a request slot or the rate limiter does not count.
+    """
+    threshold = _latency_tracker.percentile(float(settings.get('hedge_percentile', 95)))
+    attempts = []  # (future, buffer, cancel event)
+    executor = ThreadPoolExecutor(max_workers=2)
+
+    def start(hedged: bool, started: Optional[threading.Event] = None):
+        buffer: Dict[int, str] = {}
+        cancel = threading.Event()
+        future = executor.submit(translate_chunk, chunk, settings, subtitles, buffer, attempt_type,
+                                 cancel=cancel, use_slot=not hedged, started=started)
+        attempts.append((future, buffer, cancel))
+        return future
+
+    try:
+        started = threading.Event()
+        start(False, started)
+        started.wait()
+        original = attempts[0][0]
+        wait([original], timeout=threshold)
+        slots = get_request_slots(settings)
+        while not original.done():
+            # No duplicate while the provider is throttling or failing, it would only add to the load
+            if get_rate_limiter(settings).expected_wait() > 0 or get_circuit_breaker(settings).is_open():
+                wait([original], timeout=HEDGE_POLL_INTERVAL)
+                continue
+            if not slots.acquire(timeout=HEDGE_POLL_INTERVAL):
+                continue
+            if original.done():
+                slots.release()
+                break
+            logger.info(f"Chunk is slower than p{settings.get('hedge_percentile', 95)} "
+                        f"of chunk latencies ({threshold:.1f} s), sending a hedged request")
+            start(True).add_done_callback(lambda future: slots.release())
+            break
+
+        best = None  # (attempt, failed indices)
+        pending = [future for future, _, _ in attempts]
+        while pending:
+            done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+            pending = list(not_done)
+            for attempt in attempts:
+                if attempt[0] in done:
+                    failed = attempt[0].result()
+                    if best is None or len(failed) < len(best[1]):
+                        best = (attempt, failed)
+            if not best[1]:
+                break
+
+        for attempt in attempts:
+            if attempt is not best[0]:
+                attempt[2].set()
+        if len(attempts) > 1:
+            winner = "hedged" if best[0] is attempts[1] else "original"
+            logger.info(f"Hedged chunk: the {winner} request won")
+        return best[0][1], best[1]
+    finally:
+        executor.shutdown(wait=False)
+
+def translate_chunks(chunks: List[ChunkInfo],
+                     settings: Dict,
+                     subtitles: List[str],
+                     translated_subs: List[str],
+                     attempt_type: str = "initial",
+                     label: str = "chunk",
+                     journal: Optional[CheckpointJournal] = None) -> Set[int]:
+    """
+    Translates a list of chunks with up to settings['concurrency'] requests in flight.
+    Every chunk is translated into its own buffer, and buffers are merged into
+    translated_subs in chunk order, so the result is the same as sequential processing.
+    Successfully mapped lines are written to the checkpoint journal as soon as they are mapped
+    (with hedge=1 - once the chunk is done, as only the winning request counts).
     """
-    failed_indices = set()
     total_chunks = len(chunks)
-    for i, chunk in enumerate(chunks):
-        print(f"Translating chunk {i + 1} of {total_chunks}")
-        chunk_failed_indices = translate_chunk(chunk, settings, subtitles, translated_subs, "initial")
-        failed_indices.update(chunk_failed_indices)
-        # Exponential delay + jitter
-        delay = BASE_DELAY * (2**1) + random.uniform(0, 0.5) # attempt_number = 1 for the first attempt
-        time.sleep(delay)
+    workers = max(1, min(int(settings.get('concurrency', 1)), total_chunks or 1))
+
+    def worker(position: int, chunk: ChunkInfo):
+        print(f"Translating {label} {position} of {total_chunks}")
+        if settings.get('hedge', 0) and settings.get('_batch') is None:
+            buffer, chunk_failed = translate_chunk_hedged(chunk, settings, subtitles, attempt_type)
+            if journal is not None and buffer:
+                journal.record(buffer)
+            return buffer, chunk_failed
+        buffer: Dict[int, str] = {}
+        chunk_failed = translate_chunk(chunk, settings, subtitles, buffer, attempt_type,
+                                       on_mapped=journal.record if journal is not None else None)
+        return buffer, chunk_failed
+
+    failed_indices = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # map() yields results in submission order - merging stays deterministic
+        results = executor.map(worker, range(1, total_chunks + 1), chunks)
+        for buffer, chunk_failed in results:
+            for idx, text in buffer.items():
+                translated_subs[idx] = text
+            failed_indices.update(chunk_failed)
     return failed_indices
 
+def model_ladder(settings: Dict) -> List[str]:
+    """
+    Models of the current provider from the fastest to the strongest (gemini_model_ladder or
+    deepseek_model_ladder). Empty if no ladder is set or with backends, which choose the models themselves.
+    """
+    if settings.get('backends'):
+        return []
+    ladder = settings.get(f"{settings['api_provider']}_model_ladder", '')
+    return [model.strip() for model in ladder.split(',') if model.strip()]
+
+def settings_for_attempt(settings: Dict, attempt: int) -> Dict:
+    """
+    Returns settings with the model of the ladder for the attempt: 0 - initial translation,
+    1, 2, ... - retry attempts, the last model of the ladder is used for all further attempts.
+    Without a ladder the settings are returned unchanged.
+    """
+    ladder = model_ladder(settings)
+    if not ladder:
+        return settings
+    model_key = f"{settings['api_provider']}_model"
+    model = ladder[min(attempt, len(ladder) - 1)]
+    if settings.get(model_key) == model:
+        return settings
+    attempt_settings = dict(settings, **{model_key: model})
+    attempt_settings.pop('_gemini_cache', None)  # the context cache belongs to another model
+    return attempt_settings
+
+def initial_translation(chunks: List[ChunkInfo], settings: Dict, subtitles: List[str], translated_subs: List[str],
+                        journal: Optional[CheckpointJournal] = None) -> Set[int]:
+    """
+    Performs initial translation of subtitles (with the first model of the model ladder).
+    """
+    return translate_chunks(chunks, settings_for_attempt(settings, 0), subtitles, translated_subs, "initial", journal=journal)
+
 def retry_translation(failed_indices: Set[int],
                       settings: Dict,
                       subtitles: List[str],
-                      translated_subs: List[str]) -> Set[int]:
+                      translated_subs: List[str],
+                      journal: Optional[CheckpointJournal] = None) -> Set[int]:
     """
     Performs retry attempts to translate "tails", using create_tail_chunks.
     In each iteration, only skipped lines are translated,
-    around which overlap context is added.
+    around which overlap context is added. With a model ladder every attempt
+    uses the next (stronger) model.
     """
     current_failed_indices = failed_indices.copy()
     attempt = 1
@@ -1145,23 +3046,21 @@ def retry_translation(failed_indices: Set[int],
     overlap = 10  # can be moved to settings if desired
 
     while attempt <= max_attempts and current_failed_indices:
-        logger.info(f"\nRetry attempt № {attempt} of {max_attempts}")
+        attempt_settings = settings_for_attempt(settings, attempt)
+        if model_ladder(settings):
+            logger.info(f"\nRetry attempt № {attempt} of {max_attempts}, "
+                        f"model {attempt_settings[settings['api_provider'] + '_model']}")
+        else:
+            logger.info(f"\nRetry attempt № {attempt} of {max_attempts}")
         logger.info(f"Remaining skipped lines: {len(current_failed_indices)}")
 
         # Create tail chunks
-        tail_chunks = create_tail_chunks(current_failed_indices, subtitles, settings, overlap=overlap)
+        tail_chunks = create_tail_chunks(current_failed_indices, subtitles, settings, overlap=overlap,
+                                         translated_subs=translated_subs)
         logger.info(f"Tail chunks formed: {len(tail_chunks)}")
 
-        iteration_failed_indices = set()
-
-        for i, chunk in enumerate(tail_chunks, start=1):
-            print(f"Translating tail chunk {i} of {len(tail_chunks)}")
-            # Attempt to translate chunk
-            chunk_failed = translate_chunk(chunk, settings, subtitles, translated_subs, f"tail-retry-{attempt}")
-            iteration_failed_indices.update(chunk_failed)
-
-            # Small delay between requests
-            time.sleep(BASE_DELAY)
+        iteration_failed_indices = translate_chunks(tail_chunks, attempt_settings, subtitles, translated_subs,
+                                                    f"tail-retry-{attempt}", label="tail chunk", journal=journal)
 
         # Now, what is skipped again, will go to the next iteration
         current_failed_indices = iteration_failed_indices.copy()
@@ -1169,168 +3068,463 @@ def retry_translation(failed_indices: Set[int],
 
     return current_failed_indices
 
-def process_file(filename: str, settings: Dict):
+def dedup_subtitles(subtitles: List[str]) -> Tuple[List[str], List[int]]:
+    """
+    Collapses identical lines (same text up to whitespace) into one translation unit.
+    Returns the unique lines in order of first occurrence
+    and, for every original line, the position of its unit.
+    """
+    units = []
+    owners = []
+    positions: Dict[str, int] = {}
+    for text in subtitles:
+        key = normalize_source_text(text)
+        unit = positions.get(key)
+        if unit is None:
+            unit = positions[key] = len(units)
+            units.append(text)
+        owners.append(unit)
+    return units, owners
+
+def translate_subtitles(subtitles: List[str],
+                        settings: Dict,
+                        journal: CheckpointJournal,
+                        file_type: str) -> Tuple[List[str], Set[int]]:
+    """
+    Translates all subtitles of one file. With dedup enabled repeated lines (songs, interjections,
+    the same event on several ASS layers) are translated once, at their first occurrence,
+    and the translation is copied to every repeat.
+    Returns the list of translated texts (originals for lines that could not be translated)
+    and the indices of these untranslated lines.
+    """
+    if not settings.get('dedup', 1):
+        return translate_units(subtitles, settings, journal, file_type)
+
+    units, owners = dedup_subtitles(subtitles)
+    if len(units) < len(subtitles):
+        logger.info(f"Repeated lines translated once: {len(subtitles) - len(units)} of {len(subtitles)}")
+    translated_units, failed_units = translate_units(units, settings, journal, file_type)
+
+    translated_subs = [translated_units[unit] for unit in owners]
+    failed_indices = {idx for idx, unit in enumerate(owners) if unit in failed_units}
+    for idx in failed_indices:
+        translated_subs[idx] = subtitles[idx]
+    return translated_subs, failed_indices
+
+def translate_units(subtitles: List[str],
+                    settings: Dict,
+                    journal: CheckpointJournal,
+                    file_type: str) -> Tuple[List[str], Set[int]]:
+    """
+    Translates a list of lines: lines from the checkpoint (resume mode) and the cache
+    are reused, the rest goes through initial translation and retries of failed "tails".
+    With file_context=1 every request also gets the whole list (see open_file_context).
+    """
+    # The context cache is created for the model of the initial translation
+    settings = open_file_context(subtitles, settings_for_attempt(settings, 0))
+    try:
+        return _translate_units(subtitles, settings, journal, file_type)
+    finally:
+        close_file_context(settings)
+
+def _translate_units(subtitles: List[str],
+                     settings: Dict,
+                     journal: CheckpointJournal,
+                     file_type: str) -> Tuple[List[str], Set[int]]:
+    total_subs = len(subtitles)
+    translated_subs = subtitles.copy()
+    pending_indices = set(range(total_subs))
+
+    resume = bool(settings.get('resume', 1))
+    if resume:
+        done = {idx: text for idx, text in journal.load().items() if 0 <= idx < total_subs}
+        if done:
+            logger.info(f"Resuming from checkpoint: {len(done)} of {total_subs} lines already translated")
+            for idx, text in done.items():
+                translated_subs[idx] = text
+            pending_indices -= done.keys()
+    journal.open(keep_existing=resume)
+
+    # Lines already translated earlier are taken from the cache
+    pending_indices = apply_cached_translations(pending_indices, subtitles, translated_subs, settings)
+
+    # Initial translation in chunks
+    initial_chunks = create_chunks(pending_indices, subtitles, settings,
+                                   translated_subs=translated_subs) if pending_indices else []
+    logger.info(f"Initial translation ({file_type}): total {len(initial_chunks)} chunks")
+
+    # Translate initial chunks
+    failed_indices = initial_translation(initial_chunks, settings, subtitles, translated_subs, journal)
+
+    # Retry attempts for "tails"
+    final_failed_indices = retry_translation(failed_indices, settings, subtitles, translated_subs, journal)
+    logger.info(f"Finally untranslated lines: {len(final_failed_indices)}")
+
+    # For remaining - leave the original
+    for idx in final_failed_indices:
+        translated_subs[idx] = subtitles[idx]
+    journal.close()
+
+    return translated_subs, final_failed_indices
+
+def output_path_for(filename: str, settings: Dict) -> str:
+    """
+    Returns the output path of a file in settings['output_dir'] (created if needed). Files are saved
+    by name, or relative to settings['_input_root'] when inputs from different folders share a name.
+    """
+    output_dir = settings.get('output_dir') or 'output'
+    input_root = settings.get('_input_root')
+    if input_root:
+        output_path = os.path.join(output_dir, os.path.relpath(os.path.abspath(filename), input_root))
+    else:
+        output_path = os.path.join(output_dir, os.path.basename(filename))
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    return output_path
+
+def is_batch_collecting(settings: Dict) -> bool:
+    batch = settings.get('_batch')
+    return batch is not None and batch.collecting
+
+def process_file(filename: str, settings: Dict) -> Dict:
+    """
+    Processes one subtitle file and returns its statistics:
+    {'file', 'status' ('done', 'skipped' or 'error'), 'lines', 'failed', 'seconds'}.
+    """
     logger.info(f"\nProcessing file: {filename}")
+    started = time.monotonic()
+    stats = {'file': filename, 'status': 'skipped', 'lines': 0, 'failed': 0, 'seconds': 0.0}
+    try:
+        _process_file(filename, settings, stats)
+    finally:
+        stats['seconds'] = time.monotonic() - started
+    return stats
 
+def _process_file(filename: str, settings: Dict, stats: Dict):
     # Determine if translation is needed at all
     need_translation = settings['target_language'].lower() not in ['none', '']
-    api_key = None
+    keys_ready = False
 
     if need_translation:
-        api_key = get_api_key(settings)
-        if not api_key:
+        keys_ready = api_keys_available(settings)
+        if not keys_ready:
             logger.warning(f"API key {settings['api_provider']} not found, skipping translation.")
             return
 
+    # Determine extension (srt or ass)
+    _, ext = os.path.splitext(filename.lower())
+
+    if not need_translation and ext in ('.srt', '.ass'):
+        # Shift-only fast path: rewrite timecodes in a single streaming pass
+        output_path = output_path_for(filename, settings)
+        try:
+            stats['lines'] = retime_file(filename, output_path, settings['time_shift'])
+            logger.info(f"Saved: {output_path}")
+            stats['status'] = 'done'
+        except Exception as e:
+            logger.error(f"Error retiming {filename}: {str(e)}")
+            stats['status'] = 'error'
+        return
+
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            content = f.read()
+        journal = open_checkpoint(filename, file_sha256(filename), settings)
+        if ext == '.srt':
+            # Parse SRT line by line
+            timecodes, subtitles = read_srt(filename)
+        else:
+            # Parse ASS line by line
+            header_lines, events_format_line, dialogues, subtitles = read_ass(filename)
     except Exception as e:
         logger.error(f"Error reading file {filename}: {str(e)}")
+        stats['status'] = 'error'
         return
 
-    # Determine extension (srt or ass)
-    _, ext = os.path.splitext(filename.lower())
-
     if ext == '.srt':
         # === SRT ===
-        # Parse SRT
-        timecodes, subtitles = parse_srt(content)
         total_subs = len(subtitles)
         if not total_subs:
             logger.warning(f"File {filename} does not contain subtitles.")
             return
+        stats['lines'] = total_subs
 
         # Shift time if needed
         if settings['time_shift'] != 0:
-            timecodes = [adjust_timecode(tc, settings['time_shift']) for tc in timecodes]
+            timecodes = shift_srt_timecodes(timecodes, settings['time_shift'])
 
         translated_subs = subtitles.copy()
 
-        if need_translation and api_key:
-            # Initial translation in chunks
-            initial_chunks = create_chunks(set(range(total_subs)), subtitles, settings)
-            logger.info(f"Initial translation (SRT): total {len(initial_chunks)} chunks")
-            failed_indices = set()
-
-            # Translate initial chunks
-            for i, ch in enumerate(initial_chunks, start=1):
-                print(f"Translating chunk {i} of {len(initial_chunks)}")
-                chunk_failed = translate_chunk(ch, settings, subtitles, translated_subs, attempt_type="initial")
-                failed_indices.update(chunk_failed)
-                time.sleep(BASE_DELAY)
-
-            # Retry attempts for "tails"
-            final_failed_indices = retry_translation(failed_indices, settings, subtitles, translated_subs)
-            logger.info(f"Finally untranslated lines: {len(final_failed_indices)}")
-
-            # For remaining - leave the original
-            for idx in final_failed_indices:
-                translated_subs[idx] = subtitles[idx]
-
-        # Save result to output/<filename>
-        output_dir = 'output'
-        os.makedirs(output_dir, exist_ok=True)
-        output_path = os.path.join(output_dir, filename)
+        if need_translation and keys_ready:
+            try:
+                translated_subs, final_failed_indices = translate_subtitles(subtitles, settings, journal, "SRT")
+            except ProviderError as e:
+                logger.error(f"Translation of {filename} aborted: {e}")
+                journal.close()
+                stats['status'] = 'error'
+                return
+            stats['failed'] = len(final_failed_indices)
+            if is_batch_collecting(settings):
+                return
+
+        # Save result to <output_dir>/<filename>
+        output_path = output_path_for(filename, settings)
         try:
-            with open(output_path, 'w', encoding='utf-8') as f:
-                for i, (tc, text) in enumerate(zip(timecodes, translated_subs), 1):
-                    f.write(f"{i}\n{tc}\n{text}\n\n")
+            write_srt(output_path, timecodes, translated_subs)
             logger.info(f"Saved: {output_path}")
+            stats['status'] = 'done'
+            # The result is safe on disk, the checkpoint is no longer needed
+            if need_translation:
+                journal.remove()
         except Exception as e:
             logger.error(f"Error writing {output_path}: {str(e)}")
+            stats['status'] = 'error'
 
     elif ext == '.ass':
         # === ASS ===
-        header_lines, events_format_line, dialogues, timecodes, subtitles = parse_ass(content)
         total_subs = len(subtitles)
         if not total_subs:
             logger.warning(f"File {filename} does not contain 'Dialogue:' type lines.")
             return
+        stats['lines'] = total_subs
 
         # Time shift if needed
         if settings['time_shift'] != 0:
             adjust_timecode_ass(dialogues, settings['time_shift'])
-            # Update timecodes (SRT-like "start --> end") so that the chunk-system sees the new time
-            for i, d in enumerate(dialogues):
-                new_tc = f"{format_time_ass(d['start'])} --> {format_time_ass(d['end'])}"
-                timecodes[i] = new_tc
 
         translated_subs = subtitles.copy()
 
-        if need_translation and api_key:
-            # Initial translation in chunks
-            initial_chunks = create_chunks(set(range(total_subs)), subtitles, settings)
-            logger.info(f"Initial translation (ASS): total {len(initial_chunks)} chunks")
-            failed_indices = set()
-
-            # Translate initial chunks
-            for i, ch in enumerate(initial_chunks, start=1):
-                print(f"Translating chunk {i} of {len(initial_chunks)}")
-                chunk_failed = translate_chunk(ch, settings, subtitles, translated_subs, attempt_type="initial")
-                failed_indices.update(chunk_failed)
-                time.sleep(BASE_DELAY)
-
-            # Retry attempts for "tails"
-            final_failed_indices = retry_translation(failed_indices, settings, subtitles, translated_subs)
-            logger.info(f"Finally untranslated lines: {len(final_failed_indices)}")
-
-            # For remaining - leave the original
-            for idx in final_failed_indices:
-                translated_subs[idx] = subtitles[idx]
-
-        # Reassemble final .ass
-        output_ass = reconstruct_ass(header_lines, events_format_line, dialogues, translated_subs)
+        if need_translation and keys_ready:
+            # Only the spoken text is sent: tags become placeholders, drawings and tag-only events are skipped
+            masks = [mask_ass_text(text) for text in subtitles]
+            positions = [i for i, mask in enumerate(masks) if mask is not None]
+            skipped = total_subs - len(positions)
+            if skipped:
+                logger.info(f"Events without text to translate (drawings, tags only): {skipped}")
+            try:
+                translated_texts, final_failed_indices = translate_subtitles([masks[i][1] for i in positions],
+                                                                             settings, journal, "ASS")
+            except ProviderError as e:
+                logger.error(f"Translation of {filename} aborted: {e}")
+                journal.close()
+                stats['status'] = 'error'
+                return
+            for pos, i in enumerate(positions):
+                # Untranslated events keep their original Text field as is
+                if pos not in final_failed_indices:
+                    translated_subs[i] = unmask_ass_text(translated_texts[pos], masks[i])
+            stats['failed'] = len(final_failed_indices)
+            if is_batch_collecting(settings):
+                return
 
         # Save result
-        output_dir = 'output'
-        os.makedirs(output_dir, exist_ok=True)
-        output_path = os.path.join(output_dir, filename)
+        output_path = output_path_for(filename, settings)
         try:
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write(output_ass)
+            # Reassemble final .ass
+            write_ass(output_path, header_lines, events_format_line, dialogues, translated_subs)
             logger.info(f"Saved: {output_path}")
+            stats['status'] = 'done'
+            # The result is safe on disk, the checkpoint is no longer needed
+            if need_translation:
+                journal.remove()
         except Exception as e:
             logger.error(f"Error writing {output_path}: {str(e)}")
+            stats['status'] = 'error'
 
     else:
         logger.warning(f"File {filename} has an unsupported extension. Skipping.")
 
-def main():
+def process_files(subtitle_files: List[str], settings: Dict) -> List[Dict]:
+    """
+    Processes files on settings['file_workers'] threads at the same time.
+    All files share the rate limiter, HTTP sessions, cache and the global cap of
+    settings['concurrency'] API requests in flight.
+    """
+    file_workers = max(1, min(int(settings.get('file_workers', 1)), len(subtitle_files)))
+    if file_workers == 1:
+        return [process_file(file, settings) for file in subtitle_files]
+
+    with ThreadPoolExecutor(max_workers=file_workers) as executor:
+        futures = [executor.submit(process_file, file, settings) for file in subtitle_files]
+        results = []
+        for file, future in zip(subtitle_files, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.error(f"Error processing {file}: {str(e)}")
+                logger.exception("Error details:")
+                results.append({'file': file, 'status': 'error', 'lines': 0, 'failed': 0, 'seconds': 0.0})
+        return results
+
+def process_files_batch(subtitle_files: List[str], settings: Dict) -> List[Dict]:
+    """
+    Batch mode: the files are processed once without saving to collect chunk requests of all files,
+    the requests are sent as one provider batch job (see BatchJob), and then the files are processed
+    as usual with the batch replies. If the job fails, everything is translated with normal requests.
+    """
+    job = BatchJob(BATCH_STATE_FILE, settings)
+    job.load()
+
+    logger.info("Batch mode: collecting requests...")
+    job.collecting = True
+    process_files(subtitle_files, dict(settings, _batch=job, max_retries=0))
+    job.collecting = False
+
+    try:
+        job.run(settings_for_attempt(settings, 0))
+    except Exception as e:
+        logger.error(f"Batch job error, translating with normal requests: {str(e)}")
+
+    results = process_files(subtitle_files, dict(settings, _batch=job))
+    if all(r['status'] != 'error' for r in results):
+        job.remove()
+    return results
+
+def print_summary(results: List[Dict], total_seconds: float):
+    print("\nSummary:")
+    for r in results:
+        print(f"• {r['file']}: {r['status']}, {r['lines']} lines, {r['failed']} failed, {r['seconds']:.1f} s")
+    done = sum(1 for r in results if r['status'] == 'done')
+    translated = sum(r['lines'] - r['failed'] for r in results if r['status'] == 'done')
+    failed = sum(r['failed'] for r in results)
+    print(f"Files done: {done} of {len(results)}, lines processed: {translated}, "
+          f"failed lines: {failed}, total time: {total_seconds:.1f} s")
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Translation and time shifting of .srt and .ass subtitles using Deepseek AI or Gemini AI. "
+                    f"Options override {SETTINGS_FILE} for this run only."
+    )
+    parser.add_argument('inputs', nargs='*',
+                        help="subtitle files, folders or glob patterns (default: *.srt and *.ass in the current folder)")
+    parser.add_argument('-o', '--output-dir', help="folder for processed files (default: output)")
+    parser.add_argument('-p', '--provider', choices=['gemini', 'deepseek'], help="API provider")
+    parser.add_argument('-m', '--model', help="model of the selected provider")
+    parser.add_argument('-l', '--language', help="translation language, 'none' - time shift only")
+    parser.add_argument('-j', '--concurrency', type=int, help="parallel requests")
+    parser.add_argument('--file-workers', type=int, help="files processed at the same time")
+    parser.add_argument('-c', '--chunk-size', type=int, help="chunk size in characters, 0 - disabled")
+    parser.add_argument('--chunk-tokens', type=int, help="chunk size in estimated tokens (overrides --chunk-size), 0 - disabled")
+    parser.add_argument('-t', '--time-shift', type=float, help="time shift in seconds")
+    parser.add_argument('--retries', type=int, help="number of retries")
+    parser.add_argument('--timeout', type=int, help="API request timeout in seconds")
+    parser.add_argument('--backends',
+                        help="spread requests over several provider:model backends, e.g. gemini:gemini-2.0-flash,deepseek:deepseek-chat")
+    parser.add_argument('--batch', action='store_true',
+                        help="submit all chunks as one provider batch job and wait for it (cheaper, slower)")
+    parser.add_argument('--no-prompt', action='store_true',
+                        help="do not show the settings prompt and do not ask for a missing API key (for cron, containers, job queues)")
+    return parser.parse_args(argv)
+
+def apply_cli_args(settings: Dict, args: argparse.Namespace):
+    overrides = {
+        'output_dir': args.output_dir,
+        'api_provider': args.provider,
+        'target_language': args.language,
+        'concurrency': args.concurrency,
+        'file_workers': args.file_workers,
+        'chunk_size': args.chunk_size,
+        'chunk_tokens': args.chunk_tokens,
+        'time_shift': args.time_shift,
+        'max_retries': args.retries,
+        'timeout': args.timeout,
+        'backends': args.backends,
+    }
+    for key, value in overrides.items():
+        if value is not None:
+            settings[key] = value
+    if args.model:
+        settings[f"{settings['api_provider']}_model"] = args.model
+    if args.batch:
+        settings['batch'] = 1
+    if args.no_prompt:
+        settings['interactive'] = False
+
+def find_subtitle_files(inputs: List[str]) -> List[str]:
+    """
+    Expands files, folders and glob patterns into a list of .srt/.ass files without duplicates.
+    """
+    if not inputs:
+        return glob.glob('*.srt') + glob.glob('*.ass')
+
+    files = []
+    for item in inputs:
+        if glob.has_magic(item):
+            files.extend(sorted(glob.glob(item)))
+        elif os.path.isdir(item):
+            files.extend(sorted(glob.glob(os.path.join(item, '*.srt')) + glob.glob(os.path.join(item, '*.ass'))))
+        elif os.path.isfile(item):
+            files.append(item)
+        else:
+            logger.warning(f"File not found: {item}")
+    return list(dict.fromkeys(f for f in files if f.lower().endswith(('.srt', '.ass'))))
+
+def input_root(subtitle_files: List[str]) -> Optional[str]:
+    """
+    Returns the common folder of the files if several of them have the same name
+    (s1/ep01.srt and s2/ep01.srt), so their outputs keep the subfolders and do not overwrite each other.
+    None if all names are unique.
+    """
+    names = [os.path.basename(f).lower() for f in subtitle_files]
+    if len(set(names)) == len(names):
+        return None
+    return os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in subtitle_files])
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
     settings = read_settings()
+    apply_cli_args(settings, args)
+    interactive = settings.get('interactive', True)
 
     # Find all files with .srt and .ass extensions
-    subtitle_files = glob.glob('*.srt') + glob.glob('*.ass')
+    subtitle_files = find_subtitle_files(args.inputs)
     if not subtitle_files:
         logger.warning("No SRT or ASS files found for processing")
-        return
+        return 0 if interactive else 1
+    settings['_input_root'] = input_root(subtitle_files)
+
+    if interactive:
+        print("\nCurrent settings:")
+        print(f"• Time shift: {settings['time_shift']} sec")
+        print(f"• Translation language: {settings['target_language']}")
+        print(f"• API provider: {settings['api_provider']}")
 
-    print("\nCurrent settings:")
-    print(f"• Time shift: {settings['time_shift']} sec")
-    print(f"• Translation language: {settings['target_language']}")
-    print(f"• API provider: {settings['api_provider']}")
+        if settings['api_provider'] == 'deepseek':
+            api_key_status = 'set' if settings['deepseek_api_key'] else 'missing'
+            print(f"• DeepSeek API key: {api_key_status}")
+            print(f"• DeepSeek Model: {settings['deepseek_model']}")
+        elif settings['api_provider'] == 'gemini':
+            api_key_status = 'set' if settings['gemini_api_key'] else 'missing'
+            print(f"• Gemini API key: {api_key_status}")
+            print(f"• Gemini Model: {settings['gemini_model']}")
 
-    if settings['api_provider'] == 'deepseek':
-        api_key_status = 'set' if settings['deepseek_api_key'] else 'missing'
-        print(f"• DeepSeek API key: {api_key_status}")
-        print(f"• DeepSeek Model: {settings['deepseek_model']}")
-    elif settings['api_provider'] == 'gemini':
-        api_key_status = 'set' if settings['gemini_api_key'] else 'missing'
-        print(f"• Gemini API key: {api_key_status}")
-        print(f"• Gemini Model: {settings['gemini_model']}")
+        print(f"• Retries: {settings['max_retries']}")
+        print(f"• Parallel requests: {settings['concurrency']}")
+        print(f"• Parallel files: {settings['file_workers']}")
 
-    print(f"• Retries: {settings['max_retries']}")
+        if input("\nPress Enter to start or 1 for settings: ").strip() == '1':
+            configure_settings(settings)
 
-    if input("\nPress Enter to start or 1 for settings: ").strip() == '1':
-        configure_settings(settings)
+    # Ask for a missing API key once, before files are processed in parallel.
+    # Without prompt a missing key stops the run right away, as do backends without any usable key.
+    if settings['target_language'].lower() not in ['none', '']:
+        if not api_keys_available(settings) and (not interactive or settings.get('backends')):
+            return 2
 
     logger.info("Starting file processing...")
-    for file in subtitle_files:
-        process_file(file, settings)
+    started = time.monotonic()
+    try:
+        if settings.get('batch') and settings['target_language'].lower() not in ['none', '']:
+            results = process_files_batch(subtitle_files, settings)
+        else:
+            results = process_files(subtitle_files, settings)
+    finally:
+        log_backend_stats()
+        close_http_sessions()
+        close_translation_cache()
+    print_summary(results, time.monotonic() - started)
 
     logger.info("Processing completed")
+    return 1 if any(r['status'] == 'error' for r in results) else 0
 
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())